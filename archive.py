@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Date-partitioned archive of message_logs rows past the retention window.
+
+Rows are stored as gzip-compressed CSV, one file per UTC day:
+
+    <root>/YYYY/MM/message_logs-YYYY-MM-DD.csv.gz
+
+Each ``append`` adds a new gzip member to the day's file, so archiving never
+rewrites existing data; gzip readers treat the members as one stream.  The
+first member of a file starts with a header row.  Columns match the rows
+``Database.iter_logs`` yields, with the timestamp as unix seconds.
+"""
+
+import csv
+import gzip
+import io
+import os
+from datetime import date, datetime, timedelta, timezone
+
+HEADER = ["chat_id", "user_id", "username", "message", "timestamp"]
+
+
+def _int(value: str):
+    return int(value) if value else None
+
+
+def _day(ts: int) -> date:
+    return datetime.fromtimestamp(ts, timezone.utc).date()
+
+
+def partition_path(root: str, day: date) -> str:
+    return os.path.join(root, f"{day:%Y}", f"{day:%m}", f"message_logs-{day:%Y-%m-%d}.csv.gz")
+
+
+def append(root: str, rows) -> int:
+    """Append ``(chat_id, user_id, username, message, timestamp)`` rows.
+
+    Returns how many rows were written.  Files are flushed and fsynced before
+    returning, so callers may delete the rows from the database afterwards.
+    """
+    by_day = {}
+    for row in rows:
+        by_day.setdefault(_day(row[4]), []).append(row)
+    for day, day_rows in by_day.items():
+        path = partition_path(root, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        new = not os.path.exists(path)
+        with open(path, "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+                out = io.TextIOWrapper(gz, encoding="utf-8", newline="")
+                w = csv.writer(out)
+                if new:
+                    w.writerow(HEADER)
+                w.writerows(day_rows)
+                out.flush()
+                out.detach()
+            raw.flush()
+            os.fsync(raw.fileno())
+    return sum(len(r) for r in by_day.values())
+
+
+def days(root: str) -> list:
+    """Archived days, newest first."""
+    found = []
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            if name.startswith("message_logs-") and name.endswith(".csv.gz"):
+                found.append(date.fromisoformat(name[len("message_logs-"):-len(".csv.gz")]))
+    return sorted(found, reverse=True)
+
+
+def iter_logs(root: str, since=None, until=None, chat_id=None, user_id=None, chunk=5000):
+    """Yield archived rows matching the ``Database.iter_logs`` filters.
+
+    Days are read newest first and rows within a day in archive order,
+    ``chunk`` rows at a time; only the partitions overlapping
+    ``[since, until)`` are opened.
+    """
+    first = _day(since) if since is not None else date.min
+    last = _day(until - 1) if until is not None else date.max
+    for day in days(root):
+        if not first <= day <= last:
+            continue
+        rows = []
+        with gzip.open(partition_path(root, day), "rt", encoding="utf-8", newline="") as f:
+            for rec in csv.reader(f):
+                if rec == HEADER:
+                    continue
+                row = (_int(rec[0]), _int(rec[1]), rec[2], rec[3], int(rec[4]))
+                if ((since is not None and row[4] < since)
+                        or (until is not None and row[4] >= until)
+                        or (chat_id is not None and row[0] != chat_id)
+                        or (user_id is not None and row[1] != user_id)):
+                    continue
+                rows.append(row)
+                if len(rows) >= chunk:
+                    yield rows
+                    rows = []
+        if rows:
+            yield rows
+
+
+def cutoff(retention_days: int, now: int) -> int:
+    """Unix seconds of the UTC midnight *retention_days* days before *now*.
+
+    Cutting at midnight archives whole days, so a partition normally
+    receives a single append.
+    """
+    midnight = datetime.combine(_day(now), datetime.min.time(), timezone.utc)
+    return int((midnight - timedelta(days=retention_days)).timestamp())
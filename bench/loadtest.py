@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Offline load test for the message pipeline.
+
+Starts bench/stub_translate.py, imports bot.py against a scratch database with
+TRANSLATE_URL pointed at the stub, and feeds synthetic group messages through
+the real translate_message handler.  Telegram sends are absorbed by a local
+Bot subclass with a configurable latency, so nothing leaves the machine.
+
+    python bench/loadtest.py --messages 5000 --rate 200 --chats 300 --repeat 0.6
+    python bench/loadtest.py --messages 5000 --save baseline.json
+    python bench/loadtest.py --messages 5000 --compare baseline.json
+
+Reports messages/sec, p50/p95/p99 latency from arrival to reply, upstream
+translation API calls per message and database write transactions per message.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+PHRASES = {
+    "en": ["ok", "thanks", "hello everyone", "good morning", "see you tomorrow",
+           "where are you?", "I will be there in 10 minutes", "thank you so much"],
+    "ko": ["안녕하세요", "감사합니다", "네 알겠습니다", "내일 봐요", "지금 어디에요?"],
+    "zh": ["你好", "谢谢", "好的", "明天见", "你在哪里？"],
+    "vi": ["Xin chào", "Cảm ơn bạn", "Được rồi", "Hẹn gặp lại ngày mai", "Bạn đang ở đâu?"],
+    "km": ["សួស្តី", "អរគុណ", "យល់ព្រម", "ជួបគ្នាថ្ងៃស្អែក"],
+    # Texts the local script detector cannot settle, so they reach /detect.
+    "mixed": ["ok 감사", "à bientôt", "cam on nhieu", "merci beaucoup"],
+}
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--messages", type=int, default=2000, help="messages to send")
+    p.add_argument("--rate", type=float, default=100, help="mean arrivals per second")
+    p.add_argument("--burst-every", type=float, default=10, help="seconds between bursts")
+    p.add_argument("--burst-length", type=float, default=1, help="burst duration, seconds")
+    p.add_argument("--burst-factor", type=float, default=5, help="rate multiplier in bursts")
+    p.add_argument("--chats", type=int, default=200)
+    p.add_argument("--subscribed", type=float, default=0.8, help="share of subscribed chats")
+    p.add_argument("--repeat", type=float, default=0.5,
+                   help="probability a message is a common phrase rather than unique text")
+    p.add_argument("--concurrency", type=int, default=0,
+                   help="handlers run at once (default: the Application's concurrent_updates)")
+    p.add_argument("--stub-latency-ms", type=float, default=80)
+    p.add_argument("--stub-jitter-ms", type=float, default=20)
+    p.add_argument("--stub-error-rate", type=float, default=0.0)
+    p.add_argument("--telegram-latency-ms", type=float, default=30)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--save", metavar="FILE", help="write results as JSON")
+    p.add_argument("--compare", metavar="FILE", help="print deltas against a saved run")
+    return p.parse_args()
+
+
+# ── Stub translation server ───────────────────────────────────────────────────
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_stub(args, port: int) -> subprocess.Popen:
+    proc = subprocess.Popen([
+        sys.executable, os.path.join(HERE, "stub_translate.py"), "--port", str(port),
+        "--latency-ms", str(args.stub_latency_ms), "--jitter-ms", str(args.stub_jitter_ms),
+        "--error-rate", str(args.stub_error_rate),
+    ])
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            stub_stats(port)
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("stub translation server did not start")
+
+
+def stub_stats(port: int) -> dict:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=2) as r:
+        return json.load(r)
+
+
+# ── Workload ──────────────────────────────────────────────────────────────────
+def workload(args, rng: random.Random):
+    """Yield ``(arrival_offset, chat_id, user_id, text)`` tuples."""
+    langs = list(PHRASES)
+    weights = [3, 3, 2, 2, 1, 0.5]
+    t, unique = 0.0, 0
+    for _ in range(args.messages):
+        in_burst = args.burst_every and (t % args.burst_every) < args.burst_length
+        rate = args.rate * (args.burst_factor if in_burst else 1)
+        t += rng.expovariate(rate)
+        lang = rng.choices(langs, weights)[0]
+        text = rng.choice(PHRASES[lang])
+        if rng.random() >= args.repeat:
+            unique += 1
+            text = f"{text} {unique}"
+        chat = rng.randrange(args.chats)
+        yield t, -1000 - chat, 1 + chat * 10 + rng.randrange(10), text
+
+
+# ── Harness ───────────────────────────────────────────────────────────────────
+def count_db_writes(Database) -> dict:
+    """Count write transactions issued through the data-access layer."""
+    counts = {"transactions": 0, "rows": 0}
+
+    def counted(fn, rows_of):
+        def wrapper(self, *a, **kw):
+            counts["transactions"] += 1
+            counts["rows"] += rows_of(a)
+            return fn(self, *a, **kw)
+        return wrapper
+
+    for name in ("write", "transaction", "redeem_code", "create_broadcast"):
+        if hasattr(Database, name):
+            setattr(Database, name, counted(getattr(Database, name), lambda a: 1))
+    Database.write_many = counted(Database.write_many, lambda a: len(a[1]))
+    return counts
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def drive(args, bot, handler, items) -> dict:
+    from telegram import Bot, Chat, Message, Update, User
+    from telegram.ext import CallbackContext
+
+    arrivals, replies = {}, {}
+    telegram_latency = args.telegram_latency_ms / 1000
+
+    class BenchBot(Bot):
+        async def send_message(self, chat_id, text, reply_to_message_id=None, **kwargs):
+            await asyncio.sleep(telegram_latency)
+            replies.setdefault(reply_to_message_id, time.perf_counter())
+
+    tg = BenchBot(bot.TELEGRAM_TOKEN)
+    limit = args.concurrency or max(bot.app.concurrent_updates, 1)
+    sem = asyncio.Semaphore(limit)
+    tasks = []
+
+    async def dispatch(update):
+        async with sem:
+            await handler(update, CallbackContext.from_update(update, bot.app))
+
+    start = time.perf_counter()
+    for msg_id, (offset, chat_id, user_id, text) in enumerate(items, start=1):
+        delay = start + offset - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        msg = Message(msg_id, datetime.now(timezone.utc),
+                      Chat(chat_id, Chat.SUPERGROUP, title=f"chat {chat_id}"),
+                      from_user=User(user_id, "bench", False, username=f"u{user_id}"),
+                      text=text)
+        msg.set_bot(tg)
+        arrivals[msg_id] = time.perf_counter()
+        tasks.append(asyncio.create_task(dispatch(Update(msg_id, message=msg))))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    # Replies are sent by the chat scheduler after the handler returns; wait for quiet.
+    seen, quiet_since = -1, time.perf_counter()
+    while time.perf_counter() - quiet_since < 1.0:
+        if len(replies) != seen:
+            seen, quiet_since = len(replies), time.perf_counter()
+        await asyncio.sleep(0.05)
+    end = max(replies.values(), default=time.perf_counter())
+    latencies = [replies[m] - arrivals[m] for m in replies if m in arrivals]
+    return {
+        "elapsed": end - start,
+        "replies": len(latencies),
+        "errors": sum(isinstance(r, Exception) for r in results),
+        "latencies": latencies,
+        "concurrency": limit,
+        "shed": sum(bot.chat_scheduler.dropped.values()),
+    }
+
+
+def report(result: dict, baseline: dict = None):
+    rows = [
+        ("messages", "messages", "{:.0f}"),
+        ("subscribed messages", "subscribed_messages", "{:.0f}"),
+        ("replies", "replies", "{:.0f}"),
+        ("shed messages", "shed", "{:.0f}"),
+        ("handler errors", "errors", "{:.0f}"),
+        ("throughput (msg/s)", "throughput", "{:.1f}"),
+        ("latency p50 (ms)", "p50_ms", "{:.1f}"),
+        ("latency p95 (ms)", "p95_ms", "{:.1f}"),
+        ("latency p99 (ms)", "p99_ms", "{:.1f}"),
+        ("upstream calls / msg", "upstream_per_msg", "{:.3f}"),
+        ("upstream texts / msg", "upstream_texts_per_msg", "{:.3f}"),
+        ("db write txns / msg", "db_txn_per_msg", "{:.3f}"),
+        ("db rows / msg", "db_rows_per_msg", "{:.3f}"),
+    ]
+    for label, key, fmt in rows:
+        line = f"{label:<24}{fmt.format(result[key]):>12}"
+        if baseline and key in baseline:
+            delta = result[key] - baseline[key]
+            pct = f" ({delta / baseline[key] * 100:+.1f}%)" if baseline[key] else ""
+            line += f"   baseline {fmt.format(baseline[key]):>10}{pct}"
+        print(line)
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    port = free_port()
+    tmp = tempfile.mkdtemp(prefix="gogosbot-bench-")
+    os.environ.update({
+        "TELEGRAM_TOKEN": os.environ.get("TELEGRAM_TOKEN", "123456:bench"),
+        "OWNER_PASSWORD": os.environ.get("OWNER_PASSWORD", "bench"),
+        "GOOGLE_API_KEY": os.environ.get("GOOGLE_API_KEY", "bench"),
+        "TRANSLATE_URL": f"http://127.0.0.1:{port}/language/translate/v2",
+        "DB_PATH": os.path.join(tmp, "bot.db"),
+    })
+    stub = start_stub(args, port)
+    try:
+        import bot
+        import db
+
+        now = int(time.time())
+        subscribed = set(rng.sample(range(args.chats), int(args.chats * args.subscribed)))
+        for chat in subscribed:
+            bot.store.write("user_upsert", -1000 - chat, f"chat {chat}", now + 30 * 86400)
+        bot.subscriptions.load()
+        writes = count_db_writes(db.Database)
+        handler = next(h.callback for group in bot.app.handlers.values() for h in group
+                       if getattr(h.callback, "__name__", "") == "translate_message")
+        items = list(workload(args, rng))
+
+        async def run():
+            await bot.on_startup(bot.app)
+            try:
+                return await drive(args, bot, handler, items)
+            finally:
+                await bot.on_shutdown(bot.app)
+
+        before = stub_stats(port)
+        outcome = asyncio.run(run())
+        after = stub_stats(port)
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    n = len(items)
+    lat = outcome["latencies"]
+    result = {
+        "messages": n,
+        "subscribed_messages": sum(1 for _, c, _, _ in items if -1000 - c in subscribed),
+        "replies": outcome["replies"],
+        "errors": outcome["errors"],
+        "shed": outcome["shed"],
+        "throughput": n / outcome["elapsed"] if outcome["elapsed"] else 0.0,
+        "p50_ms": percentile(lat, 50) * 1000,
+        "p95_ms": percentile(lat, 95) * 1000,
+        "p99_ms": percentile(lat, 99) * 1000,
+        "upstream_per_msg": (after["requests"] - before["requests"]) / n,
+        "upstream_texts_per_msg": (after["texts"] - before["texts"]) / n,
+        "db_txn_per_msg": writes["transactions"] / n,
+        "db_rows_per_msg": writes["rows"] / n,
+    }
+    print(f"handler concurrency {outcome['concurrency']}, offered rate {args.rate}/s "
+          f"(x{args.burst_factor} bursts), {args.chats} chats, repeat {args.repeat}")
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
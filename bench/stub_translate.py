@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Local stand-in for the Google Translate v2 REST API.
+
+Serves ``POST /language/translate/v2`` and ``.../detect`` with a configurable
+latency and error rate, and counts what it was asked for on ``GET /stats``.
+Point the bot at it with TRANSLATE_URL=http://127.0.0.1:<port>/language/translate/v2.
+
+    python bench/stub_translate.py --port 8765 --latency-ms 80 --jitter-ms 20 --error-rate 0.01
+"""
+
+import argparse
+import asyncio
+import json
+import random
+from urllib.parse import parse_qs
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+counts = {"requests": 0, "detect": 0, "translate": 0, "texts": 0, "errors": 0}
+config = {"latency": 0.0, "jitter": 0.0, "error_rate": 0.0}
+
+
+async def _q(req: Request) -> tuple:
+    """``(texts, json_body)`` from either a JSON or a form-encoded request."""
+    if req.headers.get("content-type", "").startswith("application/json"):
+        body = json.loads(await req.body())
+        q = body.get("q", [])
+    else:
+        q, body = parse_qs((await req.body()).decode()).get("q", []), {}
+    return ([q] if isinstance(q, str) else list(q)), body
+
+
+async def _delay_or_fail():
+    counts["requests"] += 1
+    await asyncio.sleep(max(0.0, random.gauss(config["latency"], config["jitter"])))
+    if random.random() < config["error_rate"]:
+        counts["errors"] += 1
+        return JSONResponse({"error": {"code": 503, "message": "stub failure"}}, status_code=503)
+    return None
+
+
+async def translate(req: Request):
+    texts, body = await _q(req)
+    failure = await _delay_or_fail()
+    if failure:
+        return failure
+    counts["translate"] += 1
+    counts["texts"] += len(texts)
+    target = body.get("target", "en")
+    return JSONResponse({"data": {"translations": [
+        {"translatedText": f"[{target}] {t}", "detectedSourceLanguage": "en"} for t in texts
+    ]}})
+
+
+async def detect(req: Request):
+    texts, _ = await _q(req)
+    failure = await _delay_or_fail()
+    if failure:
+        return failure
+    counts["detect"] += 1
+    counts["texts"] += len(texts)
+    return JSONResponse({"data": {"detections": [
+        [{"language": "en", "confidence": 0.9, "isReliable": False}] for _ in texts
+    ]}})
+
+
+async def stats(req: Request):
+    return JSONResponse(counts)
+
+
+app = Starlette(routes=[
+    Route("/language/translate/v2", translate, methods=["POST"]),
+    Route("/language/translate/v2/detect", detect, methods=["POST"]),
+    Route("/stats", stats, methods=["GET"]),
+])
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--latency-ms", type=float, default=80)
+    p.add_argument("--jitter-ms", type=float, default=20)
+    p.add_argument("--error-rate", type=float, default=0.0)
+    args = p.parse_args()
+    config.update(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                  error_rate=args.error_rate)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
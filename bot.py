@@ -4,20 +4,36 @@
 import os
 import re
 import sqlite3
-import requests
+import signal
 import threading
 import asyncio
 import csv
-from datetime import datetime, timedelta
+import gzip
+import io
+import time
+import tempfile
+import logging
+import hashlib
+import unicodedata
+from itertools import chain
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
 
-from flask import Flask, render_template_string, request
+import httpx
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from flask import Flask, Response as FlaskResponse, render_template_string, request
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Mount, Route
 from telegram import (
     Update,
-    Bot,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     ReplyKeyboardMarkup,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -27,19 +43,102 @@ from telegram.ext import (
     ContextTypes,
 )
 
+import archive
+import metrics
+from db import USER_FILTERS, USER_SORTS, AsyncDatabase, Database
+from metrics import timed_handler
+from translation import (
+    CircuitBreaker,
+    GoogleV2Provider,
+    OfflineProvider,
+    ProviderUnavailable,
+    ResilientProvider,
+)
+
 # ── Environment variables ──────────────────────────────────────────────────────
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OWNER_PASSWORD = os.getenv("OWNER_PASSWORD")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-for var, name in [
-    (TELEGRAM_TOKEN, "TELEGRAM_TOKEN"),
-    (OWNER_PASSWORD, "OWNER_PASSWORD"),
-    (GOOGLE_API_KEY, "GOOGLE_API_KEY"),
-]:
+# "google" (default) or "offline", a network-free echo backend for development.
+TRANSLATION_BACKEND = os.getenv("TRANSLATION_BACKEND", "google")
+if TRANSLATION_BACKEND not in ("google", "offline"):
+    raise RuntimeError(f"TRANSLATION_BACKEND must be google or offline, not {TRANSLATION_BACKEND!r}")
+required = [(TELEGRAM_TOKEN, "TELEGRAM_TOKEN"), (OWNER_PASSWORD, "OWNER_PASSWORD")]
+if TRANSLATION_BACKEND == "google":
+    required.append((GOOGLE_API_KEY, "GOOGLE_API_KEY"))
+for var, name in required:
     if not var:
         raise RuntimeError(f"{name} is not set")
 
-TRANSLATE_URL = "https://translation.googleapis.com/language/translate/v2"
+PORT = int(os.getenv("PORT", 8080))
+# "polling" (default) or "webhook"; webhook mode needs WEBHOOK_URL, the public
+# base URL Telegram should post updates to.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest()[:32]
+if BOT_MODE not in ("polling", "webhook"):
+    raise RuntimeError(f"BOT_MODE must be polling or webhook, not {BOT_MODE!r}")
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    raise RuntimeError("WEBHOOK_URL is not set")
+
+DB_PATH = os.getenv("DB_PATH", "bot.db")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "500"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))
+# message_logs rows older than RETENTION_DAYS move to gzip CSV files under
+# ARCHIVE_DIR; 0 keeps everything in the database.
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "30"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "1000"))
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "1000"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR") or os.path.join(os.path.dirname(DB_PATH), "archive")
+# Telegram refuses bot uploads over 50 MB; leave headroom for gzip buffering.
+EXPORT_PART_BYTES = int(os.getenv("EXPORT_PART_MB", "45")) * 1024 * 1024
+STATS_PAGE_SIZE = int(os.getenv("STATS_PAGE_SIZE", "20"))
+STATS_EXPIRING_DAYS = int(os.getenv("STATS_EXPIRING_DAYS", "3"))
+SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", "60"))
+REMINDER_DAYS = int(os.getenv("REMINDER_DAYS", "3"))
+REMINDER_BATCH = int(os.getenv("REMINDER_BATCH", "100"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "4"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+
+TRANSLATE_URL = os.getenv("TRANSLATE_URL", "https://translation.googleapis.com/language/translate/v2")
+TRANSLATE_TIMEOUT = float(os.getenv("TRANSLATE_TIMEOUT", "10"))
+TRANSLATE_MAX_CONNECTIONS = int(os.getenv("TRANSLATE_MAX_CONNECTIONS", "20"))
+TRANSLATE_MAX_INFLIGHT = int(os.getenv("TRANSLATE_MAX_INFLIGHT", "32"))
+# Deadline for one detect/translate call, including hedges and queueing.
+TRANSLATE_CALL_TIMEOUT = float(os.getenv("TRANSLATE_CALL_TIMEOUT", "5"))
+TRANSLATE_RETRIES = int(os.getenv("TRANSLATE_RETRIES", "1"))
+TRANSLATE_RETRY_BACKOFF = float(os.getenv("TRANSLATE_RETRY_BACKOFF", "0.2"))
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "5"))
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))
+# Calls slower than this latency percentile get one duplicate request; 0 disables.
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_RATIO = float(os.getenv("HEDGE_RATIO", "0.1"))
+TARGET_LANGS = ("en", "ko", "zh", "vi", "km")
+BATCH_WINDOW = float(os.getenv("BATCH_WINDOW_MS", "25")) / 1000
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "128"))
+BATCH_MAX_CHARS = int(os.getenv("BATCH_MAX_CHARS", "25000"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_DB_MAX_ENTRIES = int(os.getenv("CACHE_DB_MAX_ENTRIES", "500000"))
+CACHE_TTL = int(os.getenv("CACHE_TTL_DAYS", "30")) * 86400
+CACHE_WRITE_QUEUE_SIZE = int(os.getenv("CACHE_WRITE_QUEUE_SIZE", "5000"))
+CACHE_BATCH_SIZE = int(os.getenv("CACHE_BATCH_SIZE", "500"))
+CACHE_FLUSH_INTERVAL = float(os.getenv("CACHE_FLUSH_INTERVAL", "2.0"))
+DETECT_CONFIDENCE = float(os.getenv("DETECT_CONFIDENCE", "0.85"))
+# Telegram rejects text messages longer than this.
+MAX_MESSAGE_CHARS = 4096
+CHAT_WORKERS = int(os.getenv("CHAT_WORKERS", "32"))
+CHAT_QUEUE_SIZE = int(os.getenv("CHAT_QUEUE_SIZE", "20"))
+# Queued messages from one chat answered in a single reply; 1 disables.
+CHAT_COALESCE_MAX = int(os.getenv("CHAT_COALESCE_MAX", "5"))
+CHAT_MAX_AGE = float(os.getenv("CHAT_MAX_AGE", "60"))
+# Translation latency (EWMA, seconds) above which each chat keeps only its
+# newest message; 0 disables.
+CHAT_SHED_LATENCY = float(os.getenv("CHAT_SHED_LATENCY", "3"))
 
 # ── Internationalized texts ────────────────────────────────────────────────────
 texts = {
@@ -63,6 +162,7 @@ texts = {
         "code_set":           "Code {code} set for {days} days.",
         "used_code":          "Subscription extended by {days} days, until {date}.",
         "period":             "Subscription valid until {date} ({days} days remaining).",
+        "expiring":           "Translation subscription expires on {date} ({days} days left). Use /code to extend.",
     },
     "ko": {
         "choose":             "언어를 선택하세요:",
@@ -84,6 +184,7 @@ texts = {
         "code_set":           "코드 {code} 가 {days}일 연장용으로 설정되었습니다.",
         "used_code":          "{days}일 연장 완료, {date}까지 활성화되었습니다.",
         "period":             "구독 기간: {date}까지 ({days}일 남음)",
+        "expiring":           "번역 구독이 {date}에 만료됩니다 ({days}일 남음). /code 로 연장하세요.",
     },
     "zh": {
         "choose":             "请选择您的语言：",
@@ -105,6 +206,7 @@ texts = {
         "code_set":           "代码 {code} 已设置为延长 {days} 天。",
         "used_code":          "已延长 {days} 天，有效期至 {date}。",
         "period":             "订阅有效期至 {date}（剩余 {days} 天）。",
+        "expiring":           "翻译订阅将于 {date} 到期（剩余 {days} 天）。请使用 /code 延长。",
     },
     "vi": {
         "choose":             "Vui lòng chọn ngôn ngữ:",
@@ -126,6 +228,7 @@ texts = {
         "code_set":           "Mã {code} đã được đặt cho {days} ngày.",
         "used_code":          "Đã gia hạn {days} ngày, đến {date}.",
         "period":             "Đăng ký hợp lệ đến {date} ({days} ngày còn lại).",
+        "expiring":           "Gói dịch thuật sẽ hết hạn vào {date} (còn {days} ngày). Dùng /code để gia hạn.",
     },
     "km": {
         "choose":             "សូមជ្រើសរើសភាសារបស់អ្នក៖",
@@ -147,67 +250,817 @@ texts = {
         "code_set":           "កូដ {code} បានកំណត់សម្រាប់ {days} ថ្ងៃ។",
         "used_code":          "បានពង្រីក {days} ថ្ងៃ រហូតដល់ {date}។",
         "period":             "សម្បទានគ្រប់គ្រាន់រហូតដល់ {date} ({days} ថ្ងៃនៅសល់)។",
+        "expiring":           "ការជាវការបកប្រែនឹងផុតកំណត់នៅ {date} ({days} ថ្ងៃនៅសល់)។ ប្រើ /code ដើម្បីពន្យារ។",
     },
 }
 
 # ── Database setup ─────────────────────────────────────────────────────────────
-conn = sqlite3.connect("bot.db", check_same_thread=False)
-cur = conn.cursor()
-cur.executescript("""
-CREATE TABLE IF NOT EXISTS users (
-  user_id     INTEGER PRIMARY KEY,
-  username    TEXT,
-  expires_at  TEXT,
-  is_active   INTEGER
-);
-CREATE TABLE IF NOT EXISTS owner_sessions (
-  user_id     INTEGER PRIMARY KEY
-);
-CREATE TABLE IF NOT EXISTS message_logs (
-  id          INTEGER PRIMARY KEY AUTOINCREMENT,
-  user_id     INTEGER,
-  username    TEXT,
-  message     TEXT,
-  timestamp   TEXT
-);
-CREATE TABLE IF NOT EXISTS codes (
-  code        TEXT PRIMARY KEY,
-  days        INTEGER,
-  created_at  TEXT
-);
-CREATE TABLE IF NOT EXISTS codes_usage (
-  chat_id     INTEGER,
-  code        TEXT,
-  used_at     TEXT
-);
-""")
-conn.commit()
+logger = logging.getLogger(__name__)
+
+# ``store`` is for synchronous callers (startup, the Flask thread); handlers
+# on the event loop go through ``db``, which runs on a dedicated DB thread.
+store = Database(DB_PATH)
+store.migrate()
+db = AsyncDatabase(store)
+
+# ── Write-behind queues ────────────────────────────────────────────────────────
+class WriteBehindQueue:
+    """Write-behind queue for one named insert statement.
+
+    Callers enqueue rows without touching the disk; a background task commits
+    them on the DB thread in batches of up to ``batch_size`` rows or every
+    ``interval`` seconds.  When the queue is full new rows are dropped and
+    counted rather than stalling the caller.
+    """
+
+    def __init__(self, name: str, query: str, maxsize: int, batch_size: int, interval: float):
+        self.name = name
+        self.query = query
+        self.queue = asyncio.Queue(maxsize)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.task = None
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def put(self, row: tuple):
+        try:
+            self.queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            metrics.WRITES_DROPPED.labels(self.name).inc()
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush everything still queued."""
+        if self.task is None:
+            return
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+
+    async def flush(self):
+        """Wait until every row queued so far has been committed (or dropped)."""
+        if self.task is None:
+            return
+        done = asyncio.get_running_loop().create_future()
+        await self.queue.put(done)
+        await done
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "last_flush_ms": self.last_flush_ms,
+            "max_flush_ms": self.max_flush_ms,
+        }
+
+    async def _run(self):
+        # The queue carries row tuples, futures from flush() and a final None.
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            batch, marker = [], False
+            deadline = loop.time() + self.interval
+            while True:
+                if not isinstance(item, tuple):
+                    marker = item
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            if batch:
+                await self._flush(batch)
+            if marker is None:
+                return
+            if isinstance(marker, asyncio.Future):
+                marker.set_result(None)
+
+    async def _flush(self, batch: list):
+        t0 = time.perf_counter()
+        try:
+            await db.write_many(self.query, batch)
+        except sqlite3.Error:
+            logger.exception("dropping %d %s rows", len(batch), self.name)
+            self.dropped += len(batch)
+            metrics.WRITES_DROPPED.labels(self.name).inc(len(batch))
+            return
+        self.last_flush_ms = (time.perf_counter() - t0) * 1000
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+        self.written += len(batch)
+        self.flushes += 1
+
+message_log = WriteBehindQueue(
+    "message_log", "log_insert", LOG_QUEUE_SIZE, LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL
+)
+metrics.QUEUE_DEPTH.labels("message_log").set_function(message_log.queue.qsize)
+
+# ── Log retention ──────────────────────────────────────────────────────────────
+async def retire_logs(ctx: ContextTypes.DEFAULT_TYPE):
+    """Move message_logs rows past the retention window into the archive.
+
+    Each batch of RETENTION_BATCH rows is appended to its day's archive file
+    and then deleted in a short transaction of its own, so live writes keep
+    interleaving on the DB thread.  Freed pages are returned to the
+    filesystem VACUUM_PAGES at a time afterwards.
+    """
+    cutoff = archive.cutoff(RETENTION_DAYS, int(time.time()))
+    moved = 0
+    while rows := await db.all("log_expired", cutoff, RETENTION_BATCH):
+        await asyncio.to_thread(archive.append, ARCHIVE_DIR, [row[1:] for row in rows])
+        await db.write_many("log_delete", [(row[0],) for row in rows])
+        moved += len(rows)
+        metrics.LOGS_ARCHIVED.inc(len(rows))
+    if moved:
+        logger.info("archived %d message log rows before %s", moved, _date(cutoff))
+        while await db.vacuum(VACUUM_PAGES):
+            pass
 
 # ── In-memory preferences ──────────────────────────────────────────────────────
 user_lang = {}
 
+# ── Subscription cache ─────────────────────────────────────────────────────────
+def _date(ts: int):
+    """Unix seconds (as stored in the database) -> UTC calendar date."""
+    return datetime.fromtimestamp(ts, timezone.utc).date()
+
+class SubscriptionCache:
+    """chat_id -> expiry (unix seconds) of its subscription, 0 when inactive.
+
+    Loaded from ``users`` at startup and updated by every handler that changes
+    a subscription, so the message hot path never has to query the database.
+    Chats missing from the table get a negative (UNKNOWN) entry on first
+    sight.  ``total`` and ``active`` count registered and active chats and are
+    kept up to date on every change, so reading them is O(1).  A chat whose
+    expiry has passed stays in ``active`` until the expiry sweeper
+    deactivates it, at most SWEEP_INTERVAL seconds later.
+    """
+
+    UNKNOWN = -1
+
+    def __init__(self):
+        self.expiry = {}
+        self.total = 0
+        self.active = 0
+
+    def load(self):
+        self.expiry = {
+            cid: exp if act else 0
+            for cid, _, exp, act in store.all("user_all")
+        }
+        self.total = len(self.expiry)
+        self.active = sum(1 for exp in self.expiry.values() if exp > 0)
+
+    async def get(self, chat_id: int) -> int:
+        exp = self.expiry.get(chat_id)
+        if exp is None:
+            row = await db.one("user_get", chat_id)
+            self._store(chat_id, (row[0] if row[1] else 0) if row else self.UNKNOWN)
+            exp = self.expiry[chat_id]
+        return exp
+
+    def set(self, chat_id: int, expires: int):
+        self._store(chat_id, expires)
+
+    def deactivate(self, chat_id: int):
+        if self.expiry.get(chat_id, self.UNKNOWN) != self.UNKNOWN:
+            self._store(chat_id, 0)
+
+    def _store(self, chat_id: int, exp: int):
+        old = self.expiry.get(chat_id, self.UNKNOWN)
+        self.total += (exp != self.UNKNOWN) - (old != self.UNKNOWN)
+        self.active += (exp > 0) - (old > 0)
+        self.expiry[chat_id] = exp
+
+subscriptions = SubscriptionCache()
+subscriptions.load()
+
+# ── Translation cache ──────────────────────────────────────────────────────────
+class TranslationCache:
+    """Bounded in-process LRU in front of the persistent translation_cache table.
+
+    Entries are keyed by a hash of the normalized text and the target language
+    ("detect" for language detection) and expire after ``ttl`` seconds.  New
+    entries reach the table through a write-behind queue.
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, max_entries: int, db_max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.db_max_entries = db_max_entries
+        self.ttl = ttl
+        self.mem = OrderedDict()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self._writes = 0
+        self.writer = WriteBehindQueue(
+            "translation_cache", "cache_put", CACHE_WRITE_QUEUE_SIZE, CACHE_BATCH_SIZE,
+            CACHE_FLUSH_INTERVAL,
+        )
+
+    @staticmethod
+    def key(text: str, target: str) -> str:
+        norm = " ".join(unicodedata.normalize("NFC", text).split())
+        return hashlib.sha1(f"{target}\0{norm}".encode("utf-8")).hexdigest()
+
+    async def get(self, text: str, target: str):
+        k = self.key(text, target)
+        now = int(time.time())
+        hit = self.mem.get(k)
+        if hit is not None:
+            value, created = hit
+            if now - created < self.ttl:
+                self.mem.move_to_end(k)
+                self.hits += 1
+                metrics.CACHE_LOOKUPS.labels("memory").inc()
+                return value
+            del self.mem[k]
+        row = await db.one("cache_get", k, now - self.ttl)
+        if row:
+            self._remember(k, row[0], row[1])
+            self.db_hits += 1
+            metrics.CACHE_LOOKUPS.labels("db").inc()
+            return row[0]
+        self.misses += 1
+        metrics.CACHE_LOOKUPS.labels("miss").inc()
+        return None
+
+    def put(self, text: str, target: str, value: str):
+        k = self.key(text, target)
+        now = int(time.time())
+        self._remember(k, value, now)
+        self.writer.put((k, value, now))
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            db.submit(self.prune)
+
+    def prune(self):
+        """Drop expired rows and trim the table to ``db_max_entries`` newest."""
+        store.write("cache_prune", int(time.time()) - self.ttl, self.db_max_entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.db_hits + self.misses
+        return {
+            "entries": len(self.mem),
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.db_hits) / lookups if lookups else 0.0,
+        }
+
+    def _remember(self, k: str, value: str, created: int):
+        self.mem[k] = (value, created)
+        self.mem.move_to_end(k)
+        while len(self.mem) > self.max_entries:
+            self.mem.popitem(last=False)
+
+translation_cache = TranslationCache(CACHE_MAX_ENTRIES, CACHE_DB_MAX_ENTRIES, CACHE_TTL)
+translation_cache.prune()
+metrics.QUEUE_DEPTH.labels("translation_cache").set_function(translation_cache.writer.queue.qsize)
+
+# ── Local language detection ───────────────────────────────────────────────────
+# Letters that only occur in Vietnamese among the languages we see; generic
+# Latin accents (é, à, ô …) are shared with French and friends and prove nothing.
+_VI_ONLY = set(
+    "ăắằẳẵặđơớờởỡợưứừửữựảẩẫạậẻẽẹểễệỉịỏổỗọộủụỳỷỹỵ"
+    "ĂẮẰẲẴẶĐƠỚỜỞỠỢƯỨỪỬỮỰẢẨẪẠẬẺẼẸỂỄỆỈỊỎỔỖỌỘỦỤỲỶỸỴ"
+)
+# Short words such as "an", "on", "do" are left out: they are also common in
+# Vietnamese typed without diacritics.
+_EN_WORDS = {
+    "the", "is", "are", "was", "i", "you", "we", "it", "of", "and", "for",
+    "this", "that", "what", "ok", "okay", "thanks", "thank", "hi", "hello",
+    "yes", "please", "my", "your", "can", "will", "have", "not", "with",
+}
+
+def _script(ch: str) -> str:
+    o = ord(ch)
+    if 0xAC00 <= o <= 0xD7A3 or 0x1100 <= o <= 0x11FF or 0x3130 <= o <= 0x318F:
+        return "ko"
+    if 0x1780 <= o <= 0x17FF or 0x19E0 <= o <= 0x19FF:
+        return "km"
+    if 0x4E00 <= o <= 0x9FFF or 0x3400 <= o <= 0x4DBF or 0xF900 <= o <= 0xFAFF:
+        return "zh"
+    if 0x3040 <= o <= 0x30FF:
+        return "ja"
+    if ch in _VI_ONLY:
+        return "vi"
+    if o < 0x250:
+        return "latin"
+    return "other"
+
+def detect_script(text: str) -> tuple:
+    """Guess the language of *text* from its characters alone.
+
+    Returns ``(lang, confidence)``; ``lang`` is None when nothing can be said.
+    """
+    counts = {}
+    for ch in text:
+        if ch.isalpha():
+            s = _script(ch)
+            counts[s] = counts.get(s, 0) + 1
+    letters = sum(counts.values())
+    if not letters or counts.get("ja") or counts.get("other", 0) * 4 > letters:
+        return None, 0.0
+    latin = counts.get("latin", 0) + counts.get("vi", 0)
+    native = {k: v for k, v in counts.items() if k in ("ko", "km", "zh")}
+    if native:
+        lang, n = max(native.items(), key=lambda kv: kv[1])
+        if n < sum(native.values()) * 0.9:
+            return None, 0.0
+        return lang, 0.6 + 0.4 * n / letters
+    if counts.get("vi"):
+        return "vi", 0.9 + 0.1 * latin / letters
+    if all(ord(ch) < 0x80 for ch in text):
+        words = re.findall(r"[a-z']+", text.lower())
+        if any(w in _EN_WORDS for w in words):
+            return "en", 0.95
+        return "en", 0.75
+    return None, 0.5
+
 # ── Translation helpers ─────────────────────────────────────────────────────────
-def detect_language(text: str) -> str:
-    r = requests.post(f"{TRANSLATE_URL}/detect",
-                      params={"key": GOOGLE_API_KEY},
-                      data={"q": text})
-    r.raise_for_status()
-    return r.json()["data"]["detections"][0][0]["language"]
-
-def translate_text(text: str, target: str) -> str:
-    r = requests.post(TRANSLATE_URL,
-                      params={"key": GOOGLE_API_KEY},
-                      json={"q": text, "target": target, "format": "text"})
-    r.raise_for_status()
-    return r.json()["data"]["translations"][0]["translatedText"]
-
-async def detect_language_async(text: str) -> str:
-    return await asyncio.get_event_loop().run_in_executor(None, detect_language, text)
-
-async def translate_text_async(text: str, target: str) -> str:
-    return await asyncio.get_event_loop().run_in_executor(None, translate_text, text, target)
+def _backend():
+    if TRANSLATION_BACKEND == "offline":
+        return OfflineProvider()
+    return GoogleV2Provider(TRANSLATE_URL, GOOGLE_API_KEY, TRANSLATE_TIMEOUT,
+                            TRANSLATE_MAX_CONNECTIONS, TRANSLATE_MAX_INFLIGHT)
+
+translator = ResilientProvider(
+    _backend(), CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET),
+    TRANSLATE_CALL_TIMEOUT, TRANSLATE_RETRIES, TRANSLATE_RETRY_BACKOFF,
+    HEDGE_PERCENTILE, HEDGE_RATIO,
+)
+metrics.UPSTREAM_CIRCUIT.set_function(lambda: translator.breaker.state)
+
+async def detect_language(text: str) -> str:
+    lang, confidence = detect_script(text)
+    if lang and confidence >= DETECT_CONFIDENCE:
+        return lang
+    cached = await translation_cache.get(text, "detect")
+    if cached is not None:
+        return cached
+    try:
+        remote = await translator.detect(text)
+    except (ProviderUnavailable, asyncio.TimeoutError, httpx.HTTPError):
+        # Fall back to the local guess; translation may still get through.
+        return lang or "und"
+    if translator.cacheable:
+        translation_cache.put(text, "detect", remote)
+    return remote
+
+class TranslationBatcher:
+    """Coalesces translate calls from all chats into one request per target.
+
+    Texts for the same target wait at most ``window`` seconds, or until the
+    batch reaches ``max_size`` texts / ``max_chars`` characters, and are then
+    sent as a single multi-``q`` request.  Identical texts share one slot.
+    A window of 0 disables batching.
+    """
+
+    def __init__(self, window: float, max_size: int, max_chars: int):
+        self.window = window
+        self.max_size = max_size
+        self.max_chars = max_chars
+        self.pending = {}
+        self.chars = {}
+        self.timers = {}
+        self.requests = 0
+        self.texts = 0
+        self._tasks = set()
+
+    async def translate(self, text: str, target: str) -> str:
+        if self.window <= 0:
+            self.requests += 1
+            self.texts += 1
+            return (await translator.translate([text], target))[0]
+        bucket = self.pending.get(target)
+        fut = bucket.get(text) if bucket else None
+        if fut is None:
+            if bucket and self.chars[target] + len(text) > self.max_chars:
+                self._flush(target)
+            bucket = self.pending.setdefault(target, {})
+            fut = bucket[text] = asyncio.get_running_loop().create_future()
+            self.chars[target] = self.chars.get(target, 0) + len(text)
+            if len(bucket) >= self.max_size or self.chars[target] >= self.max_chars:
+                self._flush(target)
+            elif target not in self.timers:
+                self.timers[target] = asyncio.get_running_loop().call_later(
+                    self.window, self._flush, target)
+        return await asyncio.shield(fut)
+
+    def _flush(self, target: str):
+        timer = self.timers.pop(target, None)
+        if timer:
+            timer.cancel()
+        self.chars.pop(target, None)
+        bucket = self.pending.pop(target, None)
+        if bucket:
+            task = asyncio.create_task(self._send(bucket, target))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, bucket: dict, target: str):
+        self.requests += 1
+        self.texts += len(bucket)
+        try:
+            results = await translator.translate(list(bucket), target)
+        except Exception as e:
+            for fut in bucket.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for fut, translated in zip(bucket.values(), results):
+            if not fut.done():
+                fut.set_result(translated)
+
+translation_batcher = TranslationBatcher(BATCH_WINDOW, BATCH_MAX_SIZE, BATCH_MAX_CHARS)
+metrics.QUEUE_DEPTH.labels("translate_batch").set_function(
+    lambda: sum(len(b) for b in list(translation_batcher.pending.values())))
+
+async def translate_text(text: str, target: str) -> str:
+    cached = await translation_cache.get(text, target)
+    if cached is not None:
+        return cached
+    translated = await translation_batcher.translate(text, target)
+    if translator.cacheable:
+        translation_cache.put(text, target, translated)
+    return translated
+
+async def translate_all(text: str, targets) -> dict:
+    """Translate *text* into every target concurrently; returns {target: text}."""
+    targets = list(targets)
+    results = await asyncio.gather(*(translate_text(text, t) for t in targets))
+    return dict(zip(targets, results))
+
+async def translate_reply(text: str) -> str:
+    """Detect *text*'s language and format its translations as reply lines."""
+    src = (await detect_language(text)).split("-")[0]
+    results = await translate_all(text, [t for t in TARGET_LANGS if t != src])
+    return "\n".join(f"{t}: {tr}" for t, tr in results.items())
+
+# ── Per-chat scheduling ────────────────────────────────────────────────────────
+class ChatScheduler:
+    """Fair, bounded translation work queue in front of the group handler.
+
+    Every chat gets a FIFO of at most ``queue_size`` messages (the oldest is
+    dropped when it overflows).  Chats with pending work take turns on a
+    round-robin ready queue served by ``workers`` tasks, and a chat is served
+    by one worker at a time, so replies stay in order and one noisy group
+    cannot starve the rest.  Up to ``coalesce_max`` queued messages of a chat
+    are answered in one reply.  Messages older than ``max_age`` seconds are
+    shed; while the translation latency EWMA is above ``shed_latency`` only
+    the newest message of each chat is kept.
+    """
+
+    ALPHA = 0.2
+
+    def __init__(self, workers: int, queue_size: int, coalesce_max: int,
+                 max_age: float, shed_latency: float):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.coalesce_max = max(coalesce_max, 1)
+        self.max_age = max_age
+        self.shed_latency = shed_latency
+        self.queues = {}
+        self.ready = asyncio.Queue()
+        self.tasks = []
+        self.latency = 0.0
+        self.served = 0
+        self.replies = 0
+        self.dropped = {"full": 0, "stale": 0, "overload": 0}
+
+    @property
+    def overloaded(self) -> bool:
+        return 0 < self.shed_latency < self.latency
+
+    def depth(self) -> int:
+        return sum(len(q) for q in list(self.queues.values()))
+
+    def submit(self, chat_id: int, message):
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = deque()
+            self.ready.put_nowait(chat_id)
+        elif len(queue) >= self.queue_size:
+            queue.popleft()
+            self._drop("full")
+        queue.append((time.monotonic(), message))
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 5.0):
+        """Give queued work *timeout* seconds to finish, then drop the rest.
+
+        Replies still go out here, so this must run before the Application is
+        shut down.
+        """
+        if not self.tasks:
+            return
+        try:
+            await asyncio.wait_for(self.ready.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("dropping %d queued messages on shutdown", self.depth())
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth(),
+            "chats": len(self.queues),
+            "served": self.served,
+            "replies": self.replies,
+            "dropped": sum(self.dropped.values()),
+            "latency_ms": self.latency * 1000,
+            "overloaded": self.overloaded,
+        }
+
+    def _drop(self, reason: str, n: int = 1):
+        self.dropped[reason] += n
+        metrics.CHAT_QUEUE_DROPPED.labels(reason).inc(n)
+
+    async def _work(self):
+        while True:
+            chat_id = await self.ready.get()
+            try:
+                await self._serve(chat_id)
+            except Exception:
+                logger.exception("translation for chat %s failed", chat_id)
+            finally:
+                if self.queues.get(chat_id):
+                    self.ready.put_nowait(chat_id)
+                else:
+                    self.queues.pop(chat_id, None)
+                self.ready.task_done()
+
+    async def _serve(self, chat_id: int):
+        queue = self.queues[chat_id]
+        cutoff = time.monotonic() - self.max_age
+        while queue and queue[0][0] < cutoff:
+            queue.popleft()
+            self._drop("stale")
+        if self.overloaded and len(queue) > 1:
+            self._drop("overload", len(queue) - 1)
+            while len(queue) > 1:
+                queue.popleft()
+        batch = [queue.popleft() for _ in range(min(len(queue), self.coalesce_max))]
+        if not batch:
+            return
+        t0 = time.perf_counter()
+        results = await asyncio.gather(*(translate_reply(m.text) for _, m in batch),
+                                       return_exceptions=True)
+        self.latency += self.ALPHA * (time.perf_counter() - t0 - self.latency)
+        self.served += len(batch)
+        blocks = []
+        for item, result in zip(batch, results):
+            if isinstance(result, ProviderUnavailable):
+                continue  # counted in bot_upstream_rejected_total
+            if isinstance(result, Exception):
+                logger.error("translation for chat %s failed", chat_id, exc_info=result)
+            else:
+                blocks.append((item, result))
+        for message, items, text in self._pack(blocks):
+            try:
+                with metrics.TELEGRAM_SEND_LATENCY.labels("reply").time():
+                    await message.reply_text(text)
+            except TelegramError:
+                logger.exception("could not send translation to chat %s", chat_id)
+                continue
+            self.replies += 1
+            now = time.monotonic()
+            for enqueued, _ in items:
+                metrics.MESSAGE_LATENCY.observe(now - enqueued)
+
+    @staticmethod
+    def _pack(blocks: list) -> list:
+        """Join ``(item, text)`` blocks into replies that fit one Telegram message.
+
+        Blocks carry their queued ``(enqueued_at, message)`` item.  Each reply
+        is ``(message, items, text)``: it answers the newest message it covers
+        and lists the items it completes.  A block that is too long on its own
+        is split, and its item is completed by the last part.
+        """
+        replies = []
+        for item, text in blocks:
+            parts = [text[i:i + MAX_MESSAGE_CHARS] for i in range(0, len(text), MAX_MESSAGE_CHARS)]
+            for n, part in enumerate(parts, start=1):
+                items = [item] if n == len(parts) else []
+                if replies and len(replies[-1][2]) + 2 + len(part) <= MAX_MESSAGE_CHARS:
+                    _, done, joined = replies[-1]
+                    replies[-1] = (item[1], done + items, joined + "\n\n" + part)
+                else:
+                    replies.append((item[1], items, part))
+        return replies
+
+chat_scheduler = ChatScheduler(
+    CHAT_WORKERS, CHAT_QUEUE_SIZE, CHAT_COALESCE_MAX, CHAT_MAX_AGE, CHAT_SHED_LATENCY
+)
+metrics.QUEUE_DEPTH.labels("chat").set_function(chat_scheduler.depth)
+
+# ── Broadcasts ─────────────────────────────────────────────────────────────────
+class RateLimiter:
+    """Token bucket shared by all broadcast workers.
+
+    Telegram allows a bot roughly 30 messages per second overall; ``pause``
+    stops every worker for the duration of a flood-control RetryAfter.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.resume_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.resume_at:
+                    await asyncio.sleep(self.resume_at - now)
+                    continue
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+class BroadcastRunner:
+    """Delivers broadcast jobs concurrently under a global rate limit.
+
+    Per-chat results are persisted in broadcast_targets as they come in, so
+    jobs still marked running are resumed on the next start.  Chats that have
+    blocked or removed the bot are marked inactive.
+    """
+
+    FLUSH_EVERY = 100
+
+    def __init__(self, rate: float, concurrency: int, max_attempts: int, progress_interval: float):
+        self.limiter = RateLimiter(rate)
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.progress_interval = progress_interval
+        self.tasks = {}
+
+    async def start(self, bot, owner_id: int, text: str) -> int:
+        job_id = await db.create_broadcast(owner_id, text, int(time.time()))
+        self._spawn(bot, job_id, owner_id, text)
+        return job_id
+
+    async def resume(self, bot):
+        for job_id, owner_id, text in await db.all("broadcast_running"):
+            self._spawn(bot, job_id, owner_id, text)
+
+    async def stop(self):
+        """Cancel running jobs after saving their progress; they resume later."""
+        for task in list(self.tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    def _spawn(self, bot, job_id: int, owner_id: int, text: str):
+        task = asyncio.create_task(self._run(bot, job_id, owner_id, text))
+        self.tasks[job_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job_id, None))
+
+    async def _run(self, bot, job_id: int, owner_id: int, text: str):
+        pending = deque(cid for (cid,) in await db.all("broadcast_pending", job_id))
+        counts = {"delivered": 0, "failed": 0, "blocked": 0}
+        counts.update(await db.all("broadcast_counts", job_id))
+        total = sum(counts.values())
+        counts.pop("pending", None)
+        results = []
+
+        def summary(prefix: str) -> str:
+            return (f"{prefix} #{job_id}: {sum(counts.values())}/{total} processed – "
+                    f"{counts['delivered']} delivered, {counts['failed']} failed, "
+                    f"{counts['blocked']} blocked")
+
+        async def flush():
+            batch, results[:] = results[:], []
+            if batch:
+                await db.write_many("broadcast_result", batch)
+
+        async def worker():
+            while pending:
+                chat_id = pending.popleft()
+                status, attempts, error = await self.deliver(bot, chat_id, text)
+                counts[status] += 1
+                results.append((status, attempts, error, job_id, chat_id))
+                if len(results) >= self.FLUSH_EVERY:
+                    await flush()
+
+        progress = await self._notify(bot, owner_id, summary("Broadcast"))
+        workers = asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        workers.add_done_callback(lambda f: f.cancelled() or f.exception())
+        try:
+            shown = None
+            while not workers.done():
+                await asyncio.wait([workers], timeout=self.progress_interval)
+                text_now = summary("Broadcast")
+                if progress and text_now != shown and not workers.done():
+                    shown = text_now
+                    await self._notify(bot, owner_id, text_now, progress)
+            await workers
+        finally:
+            workers.cancel()
+            await flush()
+        await db.write("broadcast_finish", int(time.time()), job_id)
+        await self._notify(bot, owner_id, summary("Broadcast finished"), progress)
+
+    async def deliver(self, bot, chat_id: int, text: str) -> tuple:
+        """Send one message within the rate limit; returns ``(status, attempts, error)``."""
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            await self.limiter.acquire()
+            try:
+                with metrics.TELEGRAM_SEND_LATENCY.labels("broadcast").time():
+                    await bot.send_message(chat_id, text)
+                return "delivered", attempt, None
+            except RetryAfter as e:
+                self.limiter.pause(e.retry_after)
+                error = e
+            except Forbidden as e:
+                await self._deactivate(chat_id)
+                return "blocked", attempt, e.message
+            except BadRequest as e:
+                if "chat not found" in e.message.lower():
+                    await self._deactivate(chat_id)
+                    return "blocked", attempt, e.message
+                return "failed", attempt, e.message
+            except NetworkError as e:
+                error = e
+                await asyncio.sleep(2 ** (attempt - 1))
+            except TelegramError as e:
+                return "failed", attempt, e.message
+        return "failed", self.max_attempts, str(error)
+
+    async def _deactivate(self, chat_id: int):
+        await db.write("user_deactivate", chat_id)
+        subscriptions.deactivate(chat_id)
+
+    async def _notify(self, bot, owner_id: int, text: str, message=None):
+        try:
+            if message is None:
+                return await bot.send_message(owner_id, text)
+            await bot.edit_message_text(text, chat_id=owner_id, message_id=message.message_id)
+        except TelegramError:
+            logger.warning("could not report broadcast progress to %s", owner_id, exc_info=True)
+        return message
+
+broadcasts = BroadcastRunner(
+    BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_MAX_ATTEMPTS, BROADCAST_PROGRESS_INTERVAL
+)
+
+# ── Expiry sweeper ─────────────────────────────────────────────────────────────
+async def sweep_expired(ctx: ContextTypes.DEFAULT_TYPE):
+    """Deactivate expired chats in bulk and remind chats about to expire.
+
+    Runs every SWEEP_INTERVAL seconds on the job queue.  Reminders go out in
+    batches of REMINDER_BATCH through the broadcast rate limiter, once per
+    subscription period, with one line per group language.
+    """
+    now = int(time.time())
+    expired = await db.expire_due(now)
+    for cid in expired:
+        subscriptions.deactivate(cid)
+    metrics.SUBSCRIPTIONS_EXPIRED.inc(len(expired))
+
+    horizon = now + REMINDER_DAYS * 86400
+    while due := await db.all("user_remind_due", now, horizon, REMINDER_BATCH):
+        results = await asyncio.gather(*(
+            broadcasts.deliver(ctx.bot, cid, "\n".join(
+                texts[lang]["expiring"].format(date=_date(exp), days=max((exp - now) // 86400, 0))
+                for lang in TARGET_LANGS
+            ))
+            for cid, exp in due
+        ))
+        for status, _, _ in results:
+            metrics.EXPIRY_REMINDERS.labels(status).inc()
+        await db.write_many("user_reminded", [(exp, cid) for cid, exp in due])
 
 # ── Telegram handlers ──────────────────────────────────────────────────────────
+async def is_owner(uid: int) -> bool:
+    return await db.one("owner_check", uid) is not None
+
 async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     lang = user_lang.get(uid)
@@ -244,25 +1097,24 @@ async def choose_language(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def register(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
     lang = user_lang.get(update.effective_user.id, "en")
-    if cur.execute("SELECT 1 FROM users WHERE user_id=?", (cid,)).fetchone():
+    if await db.one("user_exists", cid):
         return await update.message.reply_text(texts[lang]["already_registered"])
-    exp = datetime.utcnow() + timedelta(days=7)
+    exp = int(time.time()) + 7 * 86400
     title = update.effective_chat.title or ""
-    cur.execute("REPLACE INTO users VALUES (?,?,?,1)",
-                (cid, title, exp.isoformat()))
-    conn.commit()
-    await update.message.reply_text(texts[lang]["registered"].format(date=exp.date()))
+    await db.write("user_upsert", cid, title, exp)
+    subscriptions.set(cid, exp)
+    await update.message.reply_text(texts[lang]["registered"].format(date=_date(exp)))
 
 async def stop(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
     lang = user_lang.get(update.effective_user.id, "en")
-    cur.execute("UPDATE users SET is_active=0 WHERE user_id=?", (cid,))
-    conn.commit()
+    await db.write("user_deactivate", cid)
+    subscriptions.deactivate(cid)
     await update.message.reply_text(texts[lang]["stopped"])
 
 async def contact(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     msg = " ".join(ctx.args)
-    for (owner_id,) in cur.execute("SELECT user_id FROM owner_sessions").fetchall():
+    for (owner_id,) in await db.all("owner_all"):
         await ctx.application.bot.send_message(owner_id, f"[Contact]\nFrom {update.effective_user.id}:\n{msg}")
     lang = user_lang.get(update.effective_user.id, "en")
     await update.message.reply_text({
@@ -273,13 +1125,12 @@ async def contact(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def period(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
     lang = user_lang.get(update.effective_user.id, "en")
-    row = cur.execute("SELECT expires_at,is_active FROM users WHERE user_id=?", (cid,)).fetchone()
+    row = await db.one("user_get", cid)
     if not row or row[1] == 0:
         return await update.message.reply_text("No active subscription.")
-    expires = datetime.fromisoformat(row[0])
-    days = max((expires - datetime.utcnow()).days, 0)
+    days = max((row[0] - int(time.time())) // 86400, 0)
     await update.message.reply_text(
-        texts[lang]["period"].format(date=expires.date(), days=days)
+        texts[lang]["period"].format(date=_date(row[0]), days=days)
     )
 
 async def auth(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -287,15 +1138,14 @@ async def auth(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text(texts["en"]["invalid_sc"])
     uid = update.effective_user.id
     if ctx.args[0] == OWNER_PASSWORD:
-        cur.execute("INSERT OR IGNORE INTO owner_sessions VALUES(?)", (uid,))
-        conn.commit()
+        await db.write("owner_add", uid)
         await update.message.reply_text(texts["en"]["auth_ok"])
     else:
         await update.message.reply_text(texts["en"]["auth_fail"])
 
 async def help_owner(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if not cur.execute("SELECT 1 FROM owner_sessions WHERE user_id=?", (uid,)).fetchone():
+    if not await is_owner(uid):
         return
     await update.message.reply_text(texts["en"]["help"])
 
@@ -305,163 +1155,347 @@ async def code_use(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not ctx.args:
         return await update.message.reply_text(texts[lang]["invalid_sc"])
     code = ctx.args[0]
-    row = cur.execute("SELECT days FROM codes WHERE code=?", (code,)).fetchone()
-    if not row:
+    days = await db.scalar("code_get", code)
+    if days is None:
         return await update.message.reply_text(texts[lang]["no_codes"])
-    days = row[0]
-    used = cur.execute(
-        "SELECT COUNT(*) FROM codes_usage WHERE chat_id=? AND code=?", (cid, code)
-    ).fetchone()[0]
-    if used >= 1:
-        return await update.message.reply_text(texts[lang]["used_before"])
-    now = datetime.utcnow()
-    user_row = cur.execute("SELECT expires_at FROM users WHERE user_id=?", (cid,)).fetchone()
-    expires = datetime.fromisoformat(user_row[0]) if user_row else now
-    new_exp = (expires + timedelta(days=days)) if expires > now else now + timedelta(days=days)
     title = update.effective_chat.title or ""
-    cur.execute("REPLACE INTO users VALUES (?,?,?,1)",
-                (cid, title, new_exp.isoformat()))
-    cur.execute("INSERT INTO codes_usage VALUES (?,?,?)", (cid, code, now.isoformat()))
-    conn.commit()
+    new_exp = await db.redeem_code(cid, code, title, days, int(time.time()))
+    if new_exp is None:
+        return await update.message.reply_text(texts[lang]["used_before"])
+    subscriptions.set(cid, new_exp)
     await update.message.reply_text(
-        texts[lang]["used_code"].format(days=days, date=new_exp.date())
+        texts[lang]["used_code"].format(days=days, date=_date(new_exp))
     )
 
 async def scode_define(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if not cur.execute("SELECT 1 FROM owner_sessions WHERE user_id=?", (uid,)).fetchone():
+    if not await is_owner(uid):
         return
     if len(ctx.args) != 2 or not re.fullmatch(r"\d{6}", ctx.args[0]) or not ctx.args[1].isdigit():
         return await update.message.reply_text(texts["en"]["invalid_sc"])
     code, days = ctx.args[0], int(ctx.args[1])
-    now = datetime.utcnow().isoformat()
-    cur.execute("REPLACE INTO codes VALUES (?,?,?)", (code, days, now))
-    conn.commit()
+    await db.write("code_set", code, days, int(time.time()))
     await update.message.reply_text(texts["en"]["code_set"].format(code=code, days=days))
 
+async def stats_page(filter_: str, sort: str, page: int) -> tuple:
+    """Render one page of the owner's user list as ``(text, keyboard)``."""
+    now = int(time.time())
+    count, rows = await db.user_page(
+        filter_, sort, now, now + STATS_EXPIRING_DAYS * 86400,
+        STATS_PAGE_SIZE, page * STATS_PAGE_SIZE
+    )
+    pages = max((count + STATS_PAGE_SIZE - 1) // STATS_PAGE_SIZE, 1)
+    msg = (f"Total users: {subscriptions.total}\nActive users: {subscriptions.active}\n"
+           f"Filter: {filter_} ({count}) · Sort: {sort} · Page {page + 1}/{pages}\n\n")
+    for u, un, exp, act in rows:
+        msg += f"{(un or '')[:40]} (ID {u}) – Expires {_date(exp)} Active:{bool(act)}\n"
+
+    def button(label, f=filter_, s=sort, p=page):
+        return InlineKeyboardButton(label, callback_data=f"stats:{f}:{s}:{p}")
+
+    nav = []
+    if page > 0:
+        nav.append(button("◀ Prev", p=page - 1))
+    if page + 1 < pages:
+        nav.append(button("Next ▶", p=page + 1))
+    kb = [
+        nav,
+        [button(("• " if f == filter_ else "") + f, f=f, p=0) for f in USER_FILTERS],
+        [button(("• " if s == sort else "") + s, s=s, p=0) for s in USER_SORTS],
+    ]
+    return msg, InlineKeyboardMarkup([row for row in kb if row])
+
 async def stats(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if not cur.execute("SELECT 1 FROM owner_sessions WHERE user_id=?", (uid,)).fetchone():
+    if not await is_owner(uid):
         return
-    total = cur.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-    active = cur.execute(
-        "SELECT COUNT(*) FROM users WHERE is_active=1 AND expires_at>?",
-        (datetime.utcnow().isoformat(),)
-    ).fetchone()[0]
-    rows = cur.execute("SELECT user_id, username, expires_at, is_active FROM users").fetchall()
-    msg = f"Total users: {total}\nActive users: {active}\n\n"
-    for u, un, exp, act in rows:
-        msg += f"{un or ''} (ID {u}) – Expires {exp[:10]} Active:{bool(act)}\n"
-    await update.message.reply_text(msg)
+    filter_ = ctx.args[0] if ctx.args and ctx.args[0] in USER_FILTERS else "all"
+    msg, kb = await stats_page(filter_, "expires", 0)
+    await update.message.reply_text(msg, reply_markup=kb)
+
+async def stats_navigate(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    qry = update.callback_query
+    if not await is_owner(qry.from_user.id):
+        return await qry.answer()
+    await qry.answer()
+    _, filter_, sort, page = qry.data.split(":")
+    if filter_ not in USER_FILTERS or sort not in USER_SORTS:
+        return
+    msg, kb = await stats_page(filter_, sort, int(page))
+    try:
+        await qry.edit_message_text(msg, reply_markup=kb)
+    except BadRequest:
+        pass  # unchanged page
 
 async def broadcast(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if not ctx.args or not cur.execute("SELECT 1 FROM owner_sessions WHERE user_id=?", (uid,)).fetchone():
+    if not ctx.args or not await is_owner(uid):
         return
-    text = " ".join(ctx.args)
-    for (u,) in cur.execute("SELECT user_id FROM users WHERE is_active=1").fetchall():
-        try:
-            await ctx.application.bot.send_message(u, text)
-        except:
-            pass
-    await update.message.reply_text("Broadcast sent.")
+    job_id = await broadcasts.start(ctx.application.bot, uid, " ".join(ctx.args))
+    await update.message.reply_text(f"Broadcast #{job_id} started.")
+
+def parse_record_filters(args: list, last_export) -> dict:
+    """``from=YYYY-MM-DD to=YYYY-MM-DD chat=ID user=ID since`` -> iter_logs kwargs.
+
+    Raises ValueError on anything it does not understand.
+    """
+    filters = {}
+    for arg in args:
+        key, _, value = arg.partition("=")
+        if key == "since" and not value:
+            filters["since"] = max(filters.get("since") or 0, last_export or 0)
+        elif key in ("from", "to"):
+            day = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            ts = int(day.timestamp())
+            if key == "from":
+                filters["since"] = max(filters.get("since") or 0, ts)
+            else:
+                filters["until"] = ts + 86400
+        elif key in ("chat", "user"):
+            filters[f"{key}_id"] = int(value)
+        else:
+            raise ValueError(arg)
+    return filters
+
+def write_records(filters: dict, part_bytes: int) -> tuple:
+    """Stream matching logs into gzipped CSV temp files of at most ~part_bytes.
+
+    Live rows come first, then archived days.  Runs in a worker thread with
+    its own connection; memory use does not depend on how many rows match.
+    Returns ``(parts, row_count)``.
+    """
+    parts, count = [], 0
+    raw = gz = None
+    pending = 0  # bytes written to gz since raw last reflected everything
+    line = io.StringIO()
+    w = csv.writer(line)
+
+    def encode(row: list) -> bytes:
+        w.writerow(row)
+        data = line.getvalue().encode("utf-8")
+        line.seek(0)
+        line.truncate()
+        return data
+
+    header = encode(["chat_id", "user_id", "username", "message", "timestamp"])
+    for rows in chain(store.iter_logs(**filters), archive.iter_logs(ARCHIVE_DIR, **filters)):
+        for chat_id, user_id, username, message, ts in rows:
+            stamp = datetime.fromtimestamp(ts, timezone.utc).isoformat() if ts else ""
+            data = encode([chat_id, user_id, username, message, stamp])
+            # raw.tell() + pending over-estimates the compressed size; only
+            # when that estimate would cross the cap, sync-flush for the real one.
+            if gz is not None and raw.tell() + pending + len(data) > part_bytes:
+                gz.flush()
+                pending = 0
+                if raw.tell() + len(data) > part_bytes:
+                    gz.close()
+                    parts.append(raw)
+                    gz = None
+            if gz is None:
+                raw = tempfile.TemporaryFile()
+                gz = gzip.GzipFile(fileobj=raw, mode="wb")
+                gz.write(header)
+                pending = len(header)
+            gz.write(data)
+            pending += len(data)
+            count += 1
+    if gz is not None:
+        gz.close()
+        parts.append(raw)
+    return parts, count
 
 async def records(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    if not cur.execute("SELECT 1 FROM owner_sessions WHERE user_id=?", (uid,)).fetchone():
+    if not await is_owner(uid):
         return
-    rows = cur.execute(
-        "SELECT user_id, username, message, timestamp FROM message_logs ORDER BY timestamp DESC"
-    ).fetchall()
-    path = "records.csv"
-    with open(path, "w", encoding="utf-8", newline="") as f:
-        w = csv.writer(f)
-        w.writerow(["user_id", "username", "message", "timestamp"])
-        w.writerows(rows)
-    await ctx.application.bot.send_document(uid, open(path, "rb"))
+    started = int(time.time())
+    last_export = await db.scalar("export_mark_get", uid)
+    try:
+        filters = parse_record_filters(ctx.args, last_export)
+    except ValueError:
+        return await update.message.reply_text(
+            "Usage: /records [from=YYYY-MM-DD] [to=YYYY-MM-DD] [chat=ID] [user=ID] [since]"
+        )
+    # Only an export of every row from the last mark up to now may move the
+    # mark; otherwise a later `since` would skip the rows this one left out.
+    complete = (not {"chat_id", "user_id", "until"} & filters.keys()
+                and filters.get("since", 0) <= (last_export or 0))
+    filters.setdefault("until", started)
+    # Rows stamped before `started` may still sit in the write-behind queue;
+    # commit them now or the next `since` export would skip them for good.
+    await message_log.flush()
+    parts, count = await asyncio.to_thread(write_records, filters, EXPORT_PART_BYTES)
+    if not parts:
+        return await update.message.reply_text("No matching records.")
+    stamp = datetime.fromtimestamp(started, timezone.utc).strftime("%Y%m%d-%H%M%S")
+    try:
+        for i, part in enumerate(parts, start=1):
+            suffix = f"-part{i}" if len(parts) > 1 else ""
+            part.seek(0)
+            await ctx.application.bot.send_document(
+                uid, part, filename=f"records-{stamp}{suffix}.csv.gz"
+            )
+    finally:
+        for part in parts:
+            part.close()
+    if complete:
+        await db.write("export_mark_set", uid, started)
+    await update.message.reply_text(f"Exported {count} records in {len(parts)} file(s).")
 
 async def translate_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     # 메시지 로깅 (개별 사용자)
     uid = update.effective_user.id
     txt = update.message.text
-    cur.execute(
-        "INSERT INTO message_logs (user_id,username,message,timestamp) VALUES (?,?,?,?)",
-        (uid, update.effective_user.username or "", txt, datetime.utcnow().isoformat())
+    chat_id = update.effective_chat.id
+    message_log.put(
+        (chat_id, uid, update.effective_user.username or "", txt, int(time.time()))
     )
-    conn.commit()
 
     # 구독 확인 (그룹 단위)
-    chat_id = update.effective_chat.id
-    row = cur.execute(
-        "SELECT expires_at,is_active FROM users WHERE user_id=?", (chat_id,)
-    ).fetchone()
-    if not row or row[1] == 0:
-        return
-    expires_at = datetime.fromisoformat(row[0])
-    if expires_at < datetime.utcnow():
-        cur.execute("UPDATE users SET is_active=0 WHERE user_id=?", (chat_id,))
-        conn.commit()
-        return
+    expires_at = await subscriptions.get(chat_id)
+    if expires_at < time.time():
+        return  # inactive, or expired and awaiting the sweeper
 
-    # 번역 수행
-    src = await detect_language_async(txt)
-    targets = {"en", "ko", "zh", "vi", "km"} - {src}
-    outs = []
-    for t in targets:
-        tr = await translate_text_async(txt, t)
-        outs.append(f"{t}: {tr}")
-    await update.message.reply_text("\n".join(outs))
+    # 번역 수행 (채팅별 큐에서 처리)
+    chat_scheduler.submit(chat_id, update.message)
 
 # ── Flask app & callback ───────────────────────────────────────────────────────
 app_flask = Flask(__name__)
-bot = Bot(token=TELEGRAM_TOKEN)
 
 @app_flask.route("/")
 def dashboard():
-    total = cur.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-    active = cur.execute(
-        "SELECT COUNT(*) FROM users WHERE is_active=1 AND expires_at>?",
-        (datetime.utcnow().isoformat(),)
-    ).fetchone()[0]
+    total = subscriptions.total
+    active = subscriptions.active
+    cache = translation_cache.stats()
+    log = message_log.stats()
+    sched = chat_scheduler.stats()
+    upstream = translator.stats()
     return render_template_string(
         "<h1>Bot Dashboard</h1><ul><li>Total users: {{total}}</li>"
-        "<li>Active: {{active}}</li></ul>", total=total, active=active
+        "<li>Active: {{active}}</li>"
+        "<li>Translation cache: {{'%.1f' % (cache.hit_rate * 100)}}% hits "
+        "({{cache.hits + cache.db_hits}} hits / {{cache.misses}} misses)</li>"
+        "<li>Message log: {{log.depth}} queued, {{log.written}} written, "
+        "{{log.dropped}} dropped, last flush {{'%.1f' % log.last_flush_ms}} ms "
+        "(max {{'%.1f' % log.max_flush_ms}} ms)</li>"
+        "<li>Translate batching: {{batcher.texts}} texts in {{batcher.requests}} requests</li>"
+        "<li>Chat queues: {{sched.depth}} queued in {{sched.chats}} chats, "
+        "{{sched.served}} served in {{sched.replies}} replies, {{sched.dropped}} dropped, "
+        "latency {{'%.0f' % sched.latency_ms}} ms{{' (shedding)' if sched.overloaded}}</li>"
+        "<li>Translation backend: {{upstream.backend}}, circuit {{upstream.state}}, "
+        "{{upstream.hedged}} of {{upstream.calls}} calls hedged</li>"
+        "</ul>",
+        total=total, active=active, cache=cache, log=log, batcher=translation_batcher,
+        sched=sched, upstream=upstream
     )
 
 @app_flask.route("/healthz")
 def healthz():
     return "OK"
 
+@app_flask.route("/metrics")
+def metrics_endpoint():
+    body, content_type = metrics.render()
+    return FlaskResponse(body, content_type=content_type)
+
 @app_flask.route("/callback", methods=["POST"])
 def payment_callback():
     return "", 200
 
 # ── Dispatcher & launch ────────────────────────────────────────────────────────
+async def on_startup(application):
+    message_log.start()
+    translation_cache.writer.start()
+    chat_scheduler.start()
+    await broadcasts.resume(application.bot)
+
+async def on_shutdown(application):
+    await broadcasts.stop()
+    await chat_scheduler.stop()
+    await message_log.stop()
+    await translation_cache.writer.stop()
+    await translator.close()
+    await db.close()
+
+# on_startup/on_shutdown are called by run_polling_app and run_webhook rather
+# than as post_init/post_shutdown: PTB's run_polling shuts the bot's HTTP client
+# down before post_shutdown, which would leave queued replies nowhere to go.
 app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-app.add_handler(CommandHandler("start", start))
-app.add_handler(CallbackQueryHandler(choose_language, pattern=r"^lang_"))
-app.add_handler(CommandHandler("register", register))
-app.add_handler(CommandHandler("stop", stop))
-app.add_handler(CommandHandler("contact", contact))
-app.add_handler(CommandHandler("period", period))
-app.add_handler(CommandHandler("auth", auth))
-app.add_handler(CommandHandler("help", help_owner))
-app.add_handler(CommandHandler("code", code_use))
-app.add_handler(CommandHandler("scode", scode_define))
-app.add_handler(CommandHandler("stats", stats))
-app.add_handler(CommandHandler("broadcast", broadcast))
-app.add_handler(CommandHandler("records", records))
-app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, translate_message))
+app.job_queue.run_repeating(sweep_expired, interval=SWEEP_INTERVAL, first=10)
+if RETENTION_DAYS > 0:
+    app.job_queue.run_repeating(retire_logs, interval=RETENTION_INTERVAL, first=60)
+app.add_handler(CommandHandler("start", timed_handler(start)))
+app.add_handler(CallbackQueryHandler(timed_handler(choose_language), pattern=r"^lang_"))
+app.add_handler(CommandHandler("register", timed_handler(register)))
+app.add_handler(CommandHandler("stop", timed_handler(stop)))
+app.add_handler(CommandHandler("contact", timed_handler(contact)))
+app.add_handler(CommandHandler("period", timed_handler(period)))
+app.add_handler(CommandHandler("auth", timed_handler(auth)))
+app.add_handler(CommandHandler("help", timed_handler(help_owner)))
+app.add_handler(CommandHandler("code", timed_handler(code_use)))
+app.add_handler(CommandHandler("scode", timed_handler(scode_define)))
+app.add_handler(CommandHandler("stats", timed_handler(stats)))
+app.add_handler(CallbackQueryHandler(timed_handler(stats_navigate), pattern=r"^stats:"))
+app.add_handler(CommandHandler("broadcast", timed_handler(broadcast)))
+app.add_handler(CommandHandler("records", timed_handler(records)))
+app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(translate_message)))
+
+# ── ASGI app (webhook mode) ────────────────────────────────────────────────────
+async def telegram_webhook(req: Request):
+    if req.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return Response(status_code=403)
+    await app.update_queue.put(Update.de_json(await req.json(), app.bot))
+    return Response()
+
+# Telegram updates are handled natively; /, /healthz and /callback stay in
+# Flask and are served through the WSGI adapter on the same port.
+asgi_app = Starlette(routes=[
+    Route(WEBHOOK_PATH, telegram_webhook, methods=["POST"]),
+    Mount("/", app=WSGIMiddleware(app_flask)),
+])
+
+async def run_webhook():
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host="0.0.0.0", port=PORT))
+    async with app:
+        await on_startup(app)
+        await app.bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        await app.start()
+        try:
+            await server.serve()
+        finally:
+            await app.stop()
+            await on_shutdown(app)
+
+async def run_polling_app():
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    async with app:
+        await on_startup(app)
+        # 웹훅 제거 및 pending updates 삭제
+        await app.updater.start_polling(drop_pending_updates=True)
+        await app.start()
+        try:
+            await stopping.wait()
+        finally:
+            await app.updater.stop()
+            await app.stop()
+            await on_shutdown(app)
 
 def main():
-    # 웹훅 제거 및 pending updates 삭제
-    bot.delete_webhook(drop_pending_updates=True)
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook())
+        return
 
     threading.Thread(
-        target=lambda: app_flask.run(host="0.0.0.0", port=int(os.getenv("PORT", 8080)))
+        target=lambda: app_flask.run(host="0.0.0.0", port=PORT), daemon=True
     ).start()
-
-    app.run_polling(drop_pending_updates=True)
+    asyncio.run(run_polling_app())
 
 if __name__ == "__main__":
     main()
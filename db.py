@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+"""SQLite data access for the bot.
+
+Every statement the bot runs is a named entry in ``QUERIES``; handlers refer
+to it by name, so each connection prepares it once and reuses the cached
+statement afterwards.  ``Database`` hands every thread its own connection,
+and ``AsyncDatabase`` runs the same operations on one dedicated thread so
+the asyncio loop never waits on the disk.
+
+The schema is versioned with ``PRAGMA user_version``: ``Database.migrate``
+applies every entry of ``MIGRATIONS`` past the file's current version, so an
+existing bot.db is upgraded in place on startup.  It also switches the file
+to incremental auto-vacuum, so space freed by log retention can be returned
+to the filesystem a few pages at a time with ``Database.vacuum``.
+"""
+
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import DB_ERRORS, DB_LATENCY
+
+logger = logging.getLogger(__name__)
+
+# Version 1 is the original schema; CREATE IF NOT EXISTS lets it adopt
+# databases created before migrations existed.
+SCHEMA_V1 = """
+CREATE TABLE IF NOT EXISTS users (
+  user_id     INTEGER PRIMARY KEY,
+  username    TEXT,
+  expires_at  TEXT,
+  is_active   INTEGER
+);
+CREATE TABLE IF NOT EXISTS owner_sessions (
+  user_id     INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS message_logs (
+  id          INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id     INTEGER,
+  username    TEXT,
+  message     TEXT,
+  timestamp   TEXT
+);
+CREATE TABLE IF NOT EXISTS codes (
+  code        TEXT PRIMARY KEY,
+  days        INTEGER,
+  created_at  TEXT
+);
+CREATE TABLE IF NOT EXISTS codes_usage (
+  chat_id     INTEGER,
+  code        TEXT,
+  used_at     TEXT
+);
+CREATE TABLE IF NOT EXISTS translation_cache (
+  key         TEXT PRIMARY KEY,
+  value       TEXT,
+  created_at  INTEGER
+);
+"""
+
+# Version 2 stores every time as integer unix seconds (UTC), adds the indexes
+# the hot queries need and makes (chat_id, code) unique in codes_usage.
+SCHEMA_V2 = """
+CREATE TABLE users_v2 (
+  user_id     INTEGER PRIMARY KEY,
+  username    TEXT,
+  expires_at  INTEGER NOT NULL DEFAULT 0,
+  is_active   INTEGER NOT NULL DEFAULT 0
+);
+INSERT INTO users_v2
+  SELECT user_id, username,
+         COALESCE(CAST(strftime('%s', expires_at) AS INTEGER), 0),
+         COALESCE(is_active, 0)
+  FROM users;
+DROP TABLE users;
+ALTER TABLE users_v2 RENAME TO users;
+CREATE INDEX idx_users_active_expires ON users (is_active, expires_at);
+
+CREATE TABLE message_logs_v2 (
+  id          INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id     INTEGER,
+  username    TEXT,
+  message     TEXT,
+  timestamp   INTEGER
+);
+INSERT INTO message_logs_v2
+  SELECT id, user_id, username, message, CAST(strftime('%s', timestamp) AS INTEGER)
+  FROM message_logs;
+DROP TABLE message_logs;
+ALTER TABLE message_logs_v2 RENAME TO message_logs;
+CREATE INDEX idx_message_logs_timestamp ON message_logs (timestamp);
+
+CREATE TABLE codes_v2 (
+  code        TEXT PRIMARY KEY,
+  days        INTEGER,
+  created_at  INTEGER
+);
+INSERT INTO codes_v2
+  SELECT code, days, CAST(strftime('%s', created_at) AS INTEGER) FROM codes;
+DROP TABLE codes;
+ALTER TABLE codes_v2 RENAME TO codes;
+
+CREATE TABLE codes_usage_v2 (
+  chat_id     INTEGER NOT NULL,
+  code        TEXT NOT NULL,
+  used_at     INTEGER,
+  PRIMARY KEY (chat_id, code)
+);
+INSERT OR IGNORE INTO codes_usage_v2
+  SELECT chat_id, code, CAST(strftime('%s', used_at) AS INTEGER)
+  FROM codes_usage ORDER BY used_at;
+DROP TABLE codes_usage;
+ALTER TABLE codes_usage_v2 RENAME TO codes_usage;
+
+CREATE INDEX idx_translation_cache_created ON translation_cache (created_at);
+"""
+
+# Version 3 records which chat a logged message came from and remembers each
+# owner's last /records export.
+SCHEMA_V3 = """
+ALTER TABLE message_logs ADD COLUMN chat_id INTEGER;
+CREATE INDEX idx_message_logs_chat ON message_logs (chat_id, timestamp);
+CREATE INDEX idx_message_logs_user ON message_logs (user_id, timestamp);
+CREATE TABLE export_marks (
+  owner_id    INTEGER PRIMARY KEY,
+  exported_at INTEGER
+);
+"""
+
+# Version 4 persists broadcast jobs and per-chat delivery state so a job
+# interrupted by a restart picks up where it stopped.
+SCHEMA_V4 = """
+CREATE TABLE broadcast_jobs (
+  id          INTEGER PRIMARY KEY AUTOINCREMENT,
+  owner_id    INTEGER,
+  text        TEXT,
+  status      TEXT NOT NULL DEFAULT 'running',
+  created_at  INTEGER,
+  finished_at INTEGER
+);
+CREATE TABLE broadcast_targets (
+  job_id      INTEGER NOT NULL,
+  chat_id     INTEGER NOT NULL,
+  status      TEXT NOT NULL DEFAULT 'pending',
+  attempts    INTEGER NOT NULL DEFAULT 0,
+  error       TEXT,
+  PRIMARY KEY (job_id, chat_id)
+);
+CREATE INDEX idx_broadcast_targets_status ON broadcast_targets (job_id, status);
+"""
+
+# Version 5 remembers which expiry each chat was last reminded about, so the
+# expiry sweeper sends one reminder per subscription period.
+SCHEMA_V5 = """
+ALTER TABLE users ADD COLUMN reminded_for INTEGER NOT NULL DEFAULT 0;
+"""
+
+MIGRATIONS = [SCHEMA_V1, SCHEMA_V2, SCHEMA_V3, SCHEMA_V4, SCHEMA_V5]
+
+# Filters and sort orders accepted by Database.user_page; :now and :soon are
+# bound to unix seconds.
+USER_FILTERS = {
+    "all":      "1",
+    "active":   "is_active=1 AND expires_at>:now",
+    "expiring": "is_active=1 AND expires_at>:now AND expires_at<=:soon",
+    "inactive": "NOT (is_active=1 AND expires_at>:now)",
+}
+USER_SORTS = {
+    "expires":  "expires_at, user_id",
+    "id":       "user_id",
+    "name":     "username COLLATE NOCASE, user_id",
+}
+
+QUERIES = {
+    # users (one row per subscribed chat)
+    "user_exists":        "SELECT 1 FROM users WHERE user_id=?",
+    "user_get":           "SELECT expires_at, is_active FROM users WHERE user_id=?",
+    "user_all":           "SELECT user_id, username, expires_at, is_active FROM users",
+    "user_upsert":        "INSERT INTO users (user_id, username, expires_at, is_active) "
+                          "VALUES (?,?,?,1) ON CONFLICT (user_id) DO UPDATE SET "
+                          "username=excluded.username, expires_at=excluded.expires_at, "
+                          "is_active=1",
+    "user_deactivate":    "UPDATE users SET is_active=0 WHERE user_id=?",
+    "user_expired":       "SELECT user_id FROM users WHERE is_active=1 AND expires_at<=?",
+    "user_expire":        "UPDATE users SET is_active=0 WHERE is_active=1 AND expires_at<=?",
+    "user_remind_due":    "SELECT user_id, expires_at FROM users "
+                          "WHERE is_active=1 AND expires_at>? AND expires_at<=? "
+                          "AND reminded_for!=expires_at LIMIT ?",
+    "user_reminded":      "UPDATE users SET reminded_for=? WHERE user_id=?",
+    # owners
+    "owner_add":          "INSERT OR IGNORE INTO owner_sessions VALUES(?)",
+    "owner_check":        "SELECT 1 FROM owner_sessions WHERE user_id=?",
+    "owner_all":          "SELECT user_id FROM owner_sessions",
+    # subscription codes
+    "code_get":           "SELECT days FROM codes WHERE code=?",
+    "code_set":           "REPLACE INTO codes VALUES (?,?,?)",
+    "code_use":           "INSERT OR IGNORE INTO codes_usage VALUES (?,?,?)",
+    # message logs
+    "log_insert":         "INSERT INTO message_logs (chat_id,user_id,username,message,timestamp) "
+                          "VALUES (?,?,?,?,?)",
+    "log_expired":        "SELECT id, chat_id, user_id, username, message, timestamp "
+                          "FROM message_logs WHERE timestamp<? ORDER BY timestamp LIMIT ?",
+    "log_delete":         "DELETE FROM message_logs WHERE id=?",
+    "export_mark_get":    "SELECT exported_at FROM export_marks WHERE owner_id=?",
+    "export_mark_set":    "REPLACE INTO export_marks VALUES (?,?)",
+    # broadcasts
+    "broadcast_create":   "INSERT INTO broadcast_jobs (owner_id,text,created_at) VALUES (?,?,?)",
+    "broadcast_targets":  "INSERT INTO broadcast_targets (job_id, chat_id) "
+                          "SELECT ?, user_id FROM users WHERE is_active=1 AND expires_at>?",
+    "broadcast_running":  "SELECT id, owner_id, text FROM broadcast_jobs WHERE status='running'",
+    "broadcast_pending":  "SELECT chat_id FROM broadcast_targets WHERE job_id=? AND status='pending'",
+    "broadcast_counts":   "SELECT status, COUNT(*) FROM broadcast_targets WHERE job_id=? "
+                          "GROUP BY status",
+    "broadcast_result":   "UPDATE broadcast_targets SET status=?, attempts=?, error=? "
+                          "WHERE job_id=? AND chat_id=?",
+    "broadcast_finish":   "UPDATE broadcast_jobs SET status='done', finished_at=? WHERE id=?",
+    # translation cache
+    "cache_get":          "SELECT value, created_at FROM translation_cache "
+                          "WHERE key=? AND created_at>?",
+    "cache_put":          "REPLACE INTO translation_cache VALUES (?,?,?)",
+    "cache_prune":        "DELETE FROM translation_cache WHERE created_at<=? OR key IN ("
+                          " SELECT key FROM translation_cache "
+                          " ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+}
+
+
+class Database:
+    """Named, synchronous operations on a per-thread connection."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        """The calling thread's connection, opened on first use."""
+        db = getattr(self._local, "conn", None)
+        if db is None:
+            db = sqlite3.connect(self.path, cached_statements=len(QUERIES) * 2)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = db
+        return db
+
+    def migrate(self):
+        """Bring the database file up to ``len(MIGRATIONS)``."""
+        db = self.connection()
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        for target, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            try:
+                db.executescript(f"BEGIN;\n{script}\nPRAGMA user_version={target};\nCOMMIT;")
+            except sqlite3.Error:
+                db.rollback()
+                raise
+            logger.info("database migrated to version %d", target)
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # Only takes effect through a full VACUUM, which cannot run in a
+            # transaction; this is a one-off rewrite of the file.
+            logger.info("enabling incremental auto-vacuum")
+            db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            db.execute("VACUUM")
+
+    def one(self, name: str, *params):
+        return self.connection().execute(QUERIES[name], params).fetchone()
+
+    def all(self, name: str, *params) -> list:
+        return self.connection().execute(QUERIES[name], params).fetchall()
+
+    def scalar(self, name: str, *params):
+        row = self.one(name, *params)
+        return row[0] if row else None
+
+    def write(self, name: str, *params) -> int:
+        """Run one statement and commit; returns the affected row count."""
+        db = self.connection()
+        with db:
+            return db.execute(QUERIES[name], params).rowcount
+
+    def write_many(self, name: str, rows) -> None:
+        db = self.connection()
+        with db:
+            db.executemany(QUERIES[name], rows)
+
+    def transaction(self, *ops) -> None:
+        """Run several ``(name, params)`` statements in a single commit."""
+        db = self.connection()
+        with db:
+            for name, params in ops:
+                db.execute(QUERIES[name], params)
+
+    def iter_logs(self, since=None, until=None, chat_id=None, user_id=None, chunk=5000):
+        """Yield filtered message_logs rows newest first, ``chunk`` rows at a time.
+
+        Runs on the calling thread's connection, so long exports belong on a
+        thread of their own rather than the shared DB thread.
+        """
+        where, params = [], []
+        for clause, value in (("timestamp>=?", since), ("timestamp<?", until),
+                              ("chat_id=?", chat_id), ("user_id=?", user_id)):
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        sql = ("SELECT chat_id, user_id, username, message, timestamp FROM message_logs"
+               + (" WHERE " + " AND ".join(where) if where else "")
+               + " ORDER BY timestamp DESC")
+        cur = self.connection().execute(sql, params)
+        try:
+            while True:
+                rows = cur.fetchmany(chunk)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            cur.close()
+
+    def user_page(self, filter_: str, sort: str, now: int, soon: int, limit: int, offset: int):
+        """One page of users for the owner's /stats view.
+
+        Returns ``(matching_count, rows)``; *filter_* and *sort* must be keys
+        of USER_FILTERS and USER_SORTS.
+        """
+        where = USER_FILTERS[filter_]
+        params = {"now": now, "soon": soon, "limit": limit, "offset": offset}
+        db = self.connection()
+        count = db.execute(f"SELECT COUNT(*) FROM users WHERE {where}", params).fetchone()[0]
+        rows = db.execute(
+            "SELECT user_id, username, expires_at, is_active FROM users "
+            f"WHERE {where} ORDER BY {USER_SORTS[sort]} LIMIT :limit OFFSET :offset",
+            params
+        ).fetchall()
+        return count, rows
+
+    def expire_due(self, now: int) -> list:
+        """Deactivate every subscription expired by *now*; returns their chat ids."""
+        db = self.connection()
+        with db:
+            ids = [cid for (cid,) in db.execute(QUERIES["user_expired"], (now,))]
+            if ids:
+                db.execute(QUERIES["user_expire"], (now,))
+        return ids
+
+    def create_broadcast(self, owner_id: int, text: str, now: int) -> int:
+        """Create a job targeting every currently active chat; returns its id."""
+        db = self.connection()
+        with db:
+            job_id = db.execute(QUERIES["broadcast_create"], (owner_id, text, now)).lastrowid
+            db.execute(QUERIES["broadcast_targets"], (job_id, now))
+        return job_id
+
+    def redeem_code(self, chat_id: int, code: str, title: str, days: int, now: int):
+        """Record one use of *code* in *chat_id* and extend its subscription.
+
+        Returns the new expiry, or None when the chat has already used the code.
+        """
+        db = self.connection()
+        with db:
+            if not db.execute(QUERIES["code_use"], (chat_id, code, now)).rowcount:
+                return None
+            row = db.execute(QUERIES["user_get"], (chat_id,)).fetchone()
+            base = row[0] if row and row[0] > now else now
+            expires = base + days * 86400
+            db.execute(QUERIES["user_upsert"], (chat_id, title, expires))
+        return expires
+
+    def vacuum(self, pages: int) -> int:
+        """Return up to *pages* free pages to the filesystem; returns how many."""
+        db = self.connection()
+        before = db.execute("PRAGMA freelist_count").fetchone()[0]
+        # executescript steps the pragma to completion; execute frees one page.
+        db.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        return before - db.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def close(self):
+        db = getattr(self._local, "conn", None)
+        if db is not None:
+            db.close()
+            self._local.conn = None
+
+
+class AsyncDatabase:
+    """Awaitable wrapper that runs ``Database`` operations on one DB thread."""
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+    async def run(self, fn, *args, op: str = None):
+        """Run ``fn(*args)`` on the DB thread, for multi-statement work.
+
+        Latency is recorded under *op*, by default the function's name.
+        """
+        op = op or fn.__name__
+        t0 = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        except Exception:
+            DB_ERRORS.labels(op).inc()
+            raise
+        finally:
+            DB_LATENCY.labels(op).observe(time.perf_counter() - t0)
+
+    def submit(self, fn, *args):
+        """Fire-and-forget variant of ``run``; failures are only logged."""
+        fut = self._executor.submit(fn, *args)
+        fut.add_done_callback(_log_failure)
+
+    async def one(self, name: str, *params):
+        return await self.run(self.db.one, name, *params, op=name)
+
+    async def all(self, name: str, *params) -> list:
+        return await self.run(self.db.all, name, *params, op=name)
+
+    async def scalar(self, name: str, *params):
+        return await self.run(self.db.scalar, name, *params, op=name)
+
+    async def write(self, name: str, *params) -> int:
+        return await self.run(self.db.write, name, *params, op=name)
+
+    async def write_many(self, name: str, rows) -> None:
+        return await self.run(self.db.write_many, name, rows, op=name)
+
+    async def transaction(self, *ops) -> None:
+        return await self.run(self.db.transaction, *ops)
+
+    async def user_page(self, filter_: str, sort: str, now: int, soon: int, limit: int, offset: int):
+        return await self.run(self.db.user_page, filter_, sort, now, soon, limit, offset)
+
+    async def expire_due(self, now: int) -> list:
+        return await self.run(self.db.expire_due, now)
+
+    async def create_broadcast(self, owner_id: int, text: str, now: int) -> int:
+        return await self.run(self.db.create_broadcast, owner_id, text, now)
+
+    async def redeem_code(self, chat_id: int, code: str, title: str, days: int, now: int):
+        return await self.run(self.db.redeem_code, chat_id, code, title, days, now)
+
+    async def vacuum(self, pages: int) -> int:
+        return await self.run(self.db.vacuum, pages)
+
+    async def close(self):
+        await self.run(self.db.close)
+        self._executor.shutdown(wait=True)
+
+
+def _log_failure(fut):
+    if fut.exception() is not None:
+        logger.error("background database write failed", exc_info=fut.exception())
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Prometheus instruments shared by the bot modules.
+
+Everything here is process-local and cheap enough to leave on in
+production; ``render`` produces the text exposition served on /metrics.
+"""
+
+import functools
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+# Upstream calls and handlers sit between a few ms and the 10 s client timeout.
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+# Group messages may wait in their chat queue for up to CHAT_MAX_AGE.
+MESSAGE_BUCKETS = LATENCY_BUCKETS + (20, 30, 60)
+# DB operations are mostly sub-millisecond.
+DB_BUCKETS = (.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .5, 1)
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_seconds", "Telegram handler latency", ["handler"], buckets=LATENCY_BUCKETS)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Telegram handlers that raised", ["handler"])
+UPSTREAM_LATENCY = Histogram(
+    "bot_upstream_seconds", "Translation API request latency", ["op", "target"],
+    buckets=LATENCY_BUCKETS)
+UPSTREAM_WAIT = Histogram(
+    "bot_upstream_wait_seconds", "Time translation requests wait for a free in-flight slot",
+    ["op"], buckets=LATENCY_BUCKETS)
+UPSTREAM_ERRORS = Counter(
+    "bot_upstream_errors_total", "Failed translation API requests", ["op"])
+UPSTREAM_HEDGES = Counter(
+    "bot_upstream_hedges_total", "Duplicate translation requests sent for slow calls", ["op"])
+UPSTREAM_RETRIES = Counter(
+    "bot_upstream_retries_total", "Translation requests retried after a transient error", ["op"])
+UPSTREAM_REJECTED = Counter(
+    "bot_upstream_rejected_total", "Translation calls refused by the open circuit breaker",
+    ["op"])
+UPSTREAM_CIRCUIT = Gauge(
+    "bot_upstream_circuit_state", "Translation circuit breaker: 0 closed, 1 half-open, 2 open")
+MESSAGE_LATENCY = Histogram(
+    "bot_message_seconds", "Group message latency from arrival to translated reply",
+    buckets=MESSAGE_BUCKETS)
+TELEGRAM_SEND_LATENCY = Histogram(
+    "bot_telegram_send_seconds", "Latency of messages sent to Telegram", ["kind"],
+    buckets=LATENCY_BUCKETS)
+DB_LATENCY = Histogram(
+    "bot_db_seconds", "Database operation latency, including the wait for the DB thread",
+    ["op"], buckets=DB_BUCKETS)
+DB_ERRORS = Counter(
+    "bot_db_errors_total", "Database operations that raised", ["op"])
+CACHE_LOOKUPS = Counter(
+    "bot_translation_cache_lookups_total", "Translation cache lookups", ["result"])
+WRITES_DROPPED = Counter(
+    "bot_write_behind_dropped_total", "Rows dropped by a write-behind queue", ["queue"])
+CHAT_QUEUE_DROPPED = Counter(
+    "bot_chat_queue_dropped_total", "Group messages shed before translation", ["reason"])
+LOGS_ARCHIVED = Counter(
+    "bot_message_logs_archived_total", "Message log rows moved to the archive")
+SUBSCRIPTIONS_EXPIRED = Counter(
+    "bot_subscriptions_expired_total", "Subscriptions deactivated by the expiry sweeper")
+EXPIRY_REMINDERS = Counter(
+    "bot_expiry_reminders_total", "Pre-expiry reminders by delivery result", ["result"])
+QUEUE_DEPTH = Gauge(
+    "bot_queue_depth", "Items waiting in internal queues", ["queue"])
+
+
+def timed_handler(fn):
+    """Wrap a Telegram handler to record its latency and failures."""
+    latency = HANDLER_LATENCY.labels(fn.__name__)
+    errors = HANDLER_ERRORS.labels(fn.__name__)
+
+    @functools.wraps(fn)
+    async def wrapper(update, ctx):
+        t0 = time.perf_counter()
+        try:
+            return await fn(update, ctx)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - t0)
+
+    return wrapper
+
+
+def render() -> tuple:
+    """``(body, content_type)`` for the /metrics endpoint."""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""Translation backends and the resilience layer in front of them.
+
+``TranslationProvider`` is the interface the bot talks to: ``detect`` the
+language of one text, ``translate`` a batch of texts into one target.
+``GoogleV2Provider`` calls the Cloud Translation v2 REST API;
+``OfflineProvider`` needs no network and is meant for development and load
+tests.  ``ResilientProvider`` wraps either with a per-call deadline,
+retries, a circuit breaker and hedged requests.
+"""
+
+import asyncio
+import contextvars
+import logging
+import random
+import time
+from collections import deque
+
+import httpx
+
+from metrics import (
+    UPSTREAM_ERRORS,
+    UPSTREAM_HEDGES,
+    UPSTREAM_LATENCY,
+    UPSTREAM_REJECTED,
+    UPSTREAM_RETRIES,
+    UPSTREAM_WAIT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Set by ResilientProvider around each call; a backend appends to the list
+# once a request actually leaves the process, so a call that timed out while
+# queued locally is not blamed on the upstream.
+_sent = contextvars.ContextVar("sent", default=None)
+
+
+class ProviderUnavailable(Exception):
+    """Raised without calling the backend while its circuit breaker is open."""
+
+
+class TranslationProvider:
+    """Interface of a translation backend."""
+
+    name = "base"
+    # Whether results may go into the persistent translation cache.
+    cacheable = True
+
+    async def detect(self, text: str) -> str:
+        raise NotImplementedError
+
+    async def translate(self, texts: list, target: str) -> list:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def retryable(self, error: Exception) -> bool:
+        """Whether a failed call may succeed if simply sent again."""
+        return False
+
+
+class GoogleV2Provider(TranslationProvider):
+    """Cloud Translation v2 over one pooled keep-alive HTTP client.
+
+    The semaphore caps how many requests are in flight at once across all
+    chats.
+    """
+
+    name = "google"
+
+    def __init__(self, url: str, api_key: str, timeout: float,
+                 max_connections: int, max_inflight: int):
+        self.url = url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.inflight = asyncio.Semaphore(max_inflight)
+        self._http = None
+
+    def client(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                params={"key": self.api_key},
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+            )
+        return self._http
+
+    async def _post(self, url: str, op: str, target: str = "", **kwargs) -> dict:
+        queued = time.perf_counter()
+        async with self.inflight:
+            t0 = time.perf_counter()
+            UPSTREAM_WAIT.labels(op).observe(t0 - queued)
+            sent = _sent.get()
+            if sent is not None:
+                sent.append(op)
+            try:
+                r = await self.client().post(url, **kwargs)
+                r.raise_for_status()
+            except httpx.HTTPError:
+                UPSTREAM_ERRORS.labels(op).inc()
+                raise
+            finally:
+                UPSTREAM_LATENCY.labels(op, target).observe(time.perf_counter() - t0)
+        return r.json()["data"]
+
+    async def detect(self, text: str) -> str:
+        data = await self._post(f"{self.url}/detect", "detect", data={"q": text})
+        return data["detections"][0][0]["language"]
+
+    async def translate(self, texts: list, target: str) -> list:
+        data = await self._post(self.url, "translate", target,
+                                json={"q": texts, "target": target, "format": "text"})
+        return [t["translatedText"] for t in data["translations"]]
+
+    def retryable(self, error: Exception) -> bool:
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code == 429 or error.response.status_code >= 500
+        return isinstance(error, httpx.TransportError)
+
+    async def close(self):
+        if self._http is not None and not self._http.is_closed:
+            await self._http.aclose()
+
+
+class OfflineProvider(TranslationProvider):
+    """Network-free backend for development and load tests.
+
+    Detection answers "und" (undetermined) and every translation is the
+    input tagged with its target language, so results are never cached.
+    """
+
+    name = "offline"
+    cacheable = False
+
+    async def detect(self, text: str) -> str:
+        return "und"
+
+    async def translate(self, texts: list, target: str) -> list:
+        return [f"[{target}] {t}" for t in texts]
+
+
+class CircuitBreaker:
+    """Closed / half-open / open breaker over consecutive failures.
+
+    After ``threshold`` failures in a row the breaker opens and rejects
+    calls for ``reset_after`` seconds.  Then one probe call is let through
+    (half-open); its outcome closes the breaker or opens it again.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, threshold: int, reset_after: float):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_after:
+                return False
+            self.state = self.HALF_OPEN
+            self.probing = False
+        if self.state == self.HALF_OPEN:
+            if self.probing:
+                return False
+            self.probing = True
+        return True
+
+    def success(self):
+        if self.state != self.CLOSED:
+            logger.info("translation circuit closed")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state != self.OPEN:
+                logger.warning("translation circuit opened after %d failures", self.failures)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def abandon(self):
+        """A call ended without saying anything about the backend; free the probe slot."""
+        self.probing = False
+
+
+class ResilientProvider(TranslationProvider):
+    """Deadline, retries, circuit breaker and hedging around another provider.
+
+    Every call must finish within ``timeout`` seconds.  Timeouts of calls
+    that reached the backend and errors the backend deems retryable feed the
+    breaker; anything else (bad requests, unparsable answers, time spent
+    queued for a local slot) says nothing about its health.  Retryable
+    errors are retried up to
+    ``retries`` times after a jittered exponential delay starting at
+    ``backoff`` seconds, as long as the delay fits inside that deadline.
+    Once enough latency samples of an operation exist, a call still running
+    after their ``hedge_percentile`` gets one duplicate request and the first
+    good answer wins; at most ``hedge_ratio`` of all calls are hedged.  A
+    percentile of 0 disables hedging.
+    """
+
+    def __init__(self, provider: TranslationProvider, breaker: CircuitBreaker, timeout: float,
+                 retries: int, backoff: float, hedge_percentile: float, hedge_ratio: float,
+                 window: int = 200):
+        self.provider = provider
+        self.name = provider.name
+        self.cacheable = provider.cacheable
+        self.breaker = breaker
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_ratio = hedge_ratio
+        self.window = window
+        self.samples = {}
+        self.calls = 0
+        self.hedged = 0
+
+    async def detect(self, text: str) -> str:
+        return await self._call("detect", self.provider.detect, text)
+
+    async def translate(self, texts: list, target: str) -> list:
+        return await self._call("translate", self.provider.translate, texts, target)
+
+    async def close(self):
+        await self.provider.close()
+
+    def hedge_delay(self, op: str):
+        """Seconds after which a call to *op* is hedged, or None."""
+        samples = self.samples.get(op)
+        if not self.hedge_percentile or not samples or len(samples) < self.window // 4:
+            return None
+        if self.hedged >= self.calls * self.hedge_ratio:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))]
+
+    async def _call(self, op: str, fn, *args):
+        if not self.breaker.allow():
+            UPSTREAM_REJECTED.labels(op).inc()
+            raise ProviderUnavailable(f"{self.name} translation backend is unavailable")
+        self.calls += 1
+        sent = []
+        token = _sent.set(sent)
+        t0 = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(self._attempts(op, fn, *args), self.timeout)
+        except asyncio.CancelledError:
+            self.breaker.abandon()
+            raise
+        except asyncio.TimeoutError:
+            if sent:
+                UPSTREAM_ERRORS.labels(op).inc()
+                self.breaker.failure()
+            else:
+                self.breaker.abandon()
+            raise
+        except Exception as e:
+            if self.provider.retryable(e):
+                self.breaker.failure()
+            else:
+                self.breaker.abandon()
+            raise
+        finally:
+            _sent.reset(token)
+        self.breaker.success()
+        self.samples.setdefault(op, deque(maxlen=self.window)).append(time.perf_counter() - t0)
+        return result
+
+    async def _attempts(self, op: str, fn, *args):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._hedged(op, fn, *args)
+            except Exception as e:
+                if attempt == self.retries or not self.provider.retryable(e):
+                    raise
+                # Full jitter, so a throttled upstream is not hit in lockstep.
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                if loop.time() + delay >= deadline:
+                    raise
+                UPSTREAM_RETRIES.labels(op).inc()
+                await asyncio.sleep(delay)
+
+    async def _hedged(self, op: str, fn, *args):
+        delay = self.hedge_delay(op)
+        if delay is None:
+            return await fn(*args)
+        pending = {asyncio.ensure_future(fn(*args))}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                self.hedged += 1
+                UPSTREAM_HEDGES.labels(op).inc()
+                pending.add(asyncio.ensure_future(fn(*args)))
+            error = None
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "state": ("closed", "half-open", "open")[self.breaker.state],
+            "calls": self.calls,
+            "hedged": self.hedged,
+        }